@@ -1,12 +1,21 @@
 import copy
-from graphs import count_graph, scatter_graph, map_accident, sum_stats_study, choropleth_graph
-from common import load_data_pickle
+from graphs import (count_graph, scatter_graph, map_accident, area_stats, sum_stats_study, choropleth_graph,
+                    trend_graph, heatmap_graph)
+from common import (load_data_arrow, load_cube_arrow, load_row_index, load_spatial_index, load_state_totals, 
+                    load_metadata, dataset_version)
+from rename import cat_study, vars_study, code_state
+import tracing
+from tracing import span, start_trace, collect
 import streamlit as st
 
 base="dark"
 textColor="#c1c1c1"
 
 st.set_page_config(layout="wide")
+
+# Con ACCIDENT_TRACE=1 se registra el tiempo de cada etapa de esta ejecución del script
+start_trace()
+
 st.title("Explorando las condiciones que conllevan a la accidentalidad en las carreteras de los Estados Unidos")
 st.subheader('Aplicación desarrollada por: [Jhon Jairo Realpe](https://github.com/jhontd03)')
 
@@ -27,16 +36,32 @@ las condiciones que conllevan a un mayor o menor grado de accidentalidad en las
 # Load data and select variables 
 ###############################################################################
 
-PATH = "data/data_accident.pkl"
-
-data_accident = load_data_pickle(PATH)
-
-states = list(data_accident['State'].unique())
-years= list(data_accident['Year'].unique())
-cat_study = ['State', 'City', 'County', 'Day of month', 
-             'Month', 'Year', 'Day of week', 'Hour', 'Route', 'Ligth condition', 'Climatic condition']     
-vars_study = ['Fatals', 'Total vehicles involved', 'Vehicles in motion', 
-              'Parked vehicles', 'Pedestrian', 'Cyclists', 'Persons in Vehicles']
+PATH = "data/data_accident"
+PATH_CUBE = "data/data_cube"
+PATH_MANIFEST = "data/data_accident/_manifest.json"
+
+# La versión de los datos identifica los resultados guardados en caché, sin tener que
+# calcular el hash de los dataframes en cada interacción
+version = dataset_version(PATH)
+
+# Las opciones de filtro se leen de los metadatos del manifiesto, sin cargar los datos
+with span('app.load_metadata'):
+    metadata = load_metadata(PATH_MANIFEST, PATH_CUBE, version=version)
+states = metadata['states']
+years = metadata['years']
+
+def load_accidents(columns):
+    """
+    Loads the accident data with the given columns, with its row and spatial indexes.
+
+    The data is only read the first time a graph needs it. The rows are always read in
+    the same order, so the indexes are shared by the data loaded with any columns.
+    """
+    with span('app.load_accidents', columns=len(columns)):
+        data = load_data_arrow(PATH, columns=['State', 'Year'] + columns, version=version)
+        index = load_row_index(PATH, data, version=version)
+        spatial = load_spatial_index(PATH, data, version=version) if 'latitude' in columns else None
+    return data, index, spatial
 
 ###############################################################################
 # Sider page 
@@ -65,29 +90,61 @@ view_map = st.sidebar.selectbox('Visualizar mapa', ['No', 'Si'])
 # Body page 
 ###############################################################################
 
+# Solo se genera la figura de la vista seleccionada en cada sección, por lo que las 
+# pestañas se sustituyen por un selector de vista
+
+with span('app.load_cube'):
+    cube_accident = load_cube_arrow(PATH_CUBE, cat_study, version=version)
+
 expander_1 = st.expander('Análisis general', expanded=True)
 
-tab1, tab2, tab3 = expander_1.tabs(["Conteo accidentes por año", "Conteo variables categóricas", "Suma total variables numéricas"])
-
-with tab1:
-    st.plotly_chart(count_graph(data_accident, state_filter, years, 'Year'), 
-                    theme="streamlit", use_container_width=True)
-
-with tab2:
-    cat_tab2 = copy.deepcopy(cat_study) 
-    cat_tab2.remove('Year')
-    cat_filter_1 = st.selectbox('Categoría', cat_tab2)
-    st.plotly_chart(count_graph(data_accident, state_filter, year_filter, cat_filter_1), 
-                    theme="streamlit", use_container_width=True)
-
-with tab3:
-    col1, col2 = st.columns(2)
-    with col1:       
-        cat_filter_2 = st.selectbox('Categoría estudio', cat_tab2)        
-    with col2:
-        study_filter = st.selectbox('Variable estudio', vars_study)
-    st.plotly_chart(sum_stats_study(data_accident, state_filter, year_filter, study_filter, cat_filter_2), 
-                    theme="streamlit", use_container_width=True)
+tab_1 = expander_1.radio('Vista', ["Conteo accidentes por año", "Conteo variables categóricas", "Suma total variables numéricas",
+                                  "Tendencia por periodo", "Hora y día de la semana"], 
+                         horizontal=True, label_visibility='collapsed')
+
+# Periodos de la tendencia, que se calculan a partir del almacén de series de tiempo del cubo
+trend_levels = {'Mes': 'month', 'Semana': 'week', 'Día': 'day', 'Trimestre': 'quarter', 'Año': 'year'}
+
+cat_tab2 = copy.deepcopy(cat_study) 
+cat_tab2.remove('Year')
+
+with expander_1:
+    if tab_1 == "Conteo accidentes por año":
+        with span('app.render', chart='count_graph'):
+            st.plotly_chart(count_graph(cube_accident, version, state_filter, years, 'Year'), 
+                            theme="streamlit", use_container_width=True)
+    
+    elif tab_1 == "Conteo variables categóricas":
+        cat_filter_1 = st.selectbox('Categoría', cat_tab2)
+        with span('app.render', chart='count_graph'):
+            st.plotly_chart(count_graph(cube_accident, version, state_filter, year_filter, cat_filter_1), 
+                            theme="streamlit", use_container_width=True)
+    
+    elif tab_1 == "Suma total variables numéricas":
+        col1, col2 = st.columns(2)
+        with col1:       
+            cat_filter_2 = st.selectbox('Categoría estudio', cat_tab2)        
+        with col2:
+            study_filter = st.selectbox('Variable estudio', vars_study)
+        with span('app.render', chart='sum_stats_study'):
+            st.plotly_chart(sum_stats_study(cube_accident, version, state_filter, year_filter, study_filter, cat_filter_2), 
+                            theme="streamlit", use_container_width=True)
+
+    elif tab_1 == "Tendencia por periodo":
+        col1, col2 = st.columns(2)
+        with col1:
+            level_filter = st.selectbox('Periodo', list(trend_levels))
+        with col2:
+            trend_filter = st.selectbox('Variable estudio', ['Total accidents'] + vars_study)
+        with span('app.render', chart='trend_graph'):
+            st.plotly_chart(trend_graph(cube_accident, version, state_filter, year_filter, trend_filter, trend_levels[level_filter]), 
+                            theme="streamlit", use_container_width=True)
+
+    else:
+        heat_filter = st.selectbox('Variable estudio', ['Total accidents'] + vars_study)
+        with span('app.render', chart='heatmap_graph'):
+            st.plotly_chart(heatmap_graph(cube_accident, version, state_filter, year_filter, heat_filter), 
+                            theme="streamlit", use_container_width=True)
     
 expander_2 = st.expander('Análisis Correlación', expanded=True)
 col1, col2, col3 = expander_2.columns(3)
@@ -98,23 +155,60 @@ with col2:
 with col3:
     z_var = st.selectbox('Variable 3', vars_study)
 
-expander_2.plotly_chart(scatter_graph(data_accident, 
-                                      year_filter, 
-                                      state_filter, 
-                                      x_var=x_var,
-                                      y_var=y_var, 
-                                      z_var=z_var), 
-                                      theme="streamlit", 
-                                      use_container_width=True)
+data_accident, index_accident, _ = load_accidents(vars_study)
+with span('app.render', chart='scatter_graph'):
+    expander_2.plotly_chart(scatter_graph(data_accident, 
+                                          version,
+                                          year_filter, 
+                                          state_filter, 
+                                          x_var=x_var,
+                                          y_var=y_var, 
+                                          z_var=z_var,
+                                          _index=index_accident), 
+                                          theme="streamlit", 
+                                          use_container_width=True)
 if view_map == 'Si':
     expander_3 = st.expander('Mapa Accidentes', expanded=True)
     var_filter = expander_3.selectbox("Parámetro Estudio", vars_study)
 
-    tab1, tab2 = expander_3.tabs(["Suma total por Estados", "Ubicación de Accidentes por Estados"])
+    tab_3 = expander_3.radio('Mapa', ["Suma total por Estados", "Ubicación de Accidentes por Estados"], 
+                             horizontal=True, label_visibility='collapsed')
+
+    with expander_3:
+        if tab_3 == "Suma total por Estados":
+            totals_accident = load_state_totals(PATH_CUBE, cube_accident, ['Total accidents'] + vars_study, code_state, version=version)
+            with span('app.render', chart='choropleth_graph'):
+                st.plotly_chart(choropleth_graph(totals_accident, version, year_filter, var_filter), 
+                                theme="streamlit", 
+                                use_container_width=True)
+        else:
+            data_map, index_map, spatial_map = load_accidents(vars_study + ['latitude', 'longitud'])
+            zoom = st.slider('Nivel de zoom', min_value=5, max_value=12, value=7)
+            area = None
+            if st.checkbox('Filtrar por distancia a un punto'):
+                col1, col2, col3 = st.columns(3)
+                lat = col1.number_input('Latitud', min_value=-90.0, max_value=90.0, value=39.8)
+                lon = col2.number_input('Longitud', min_value=-180.0, max_value=180.0, value=-98.6)
+                km = col3.number_input('Distancia (km)', min_value=1.0, max_value=1000.0, value=50.0)
+                area = (lon, lat, km)
+                stats = area_stats(data_map, version, state_filter, year_filter, var_filter, area,
+                                   _index=index_map, _spatial=spatial_map)
+                col1, col2 = st.columns(2)
+                col1.metric('Accidentes en el área', stats['count'])
+                col2.metric(var_filter, stats['sum'])
+            deck = map_accident(data_map, version, state_filter, year_filter, var_filter, 
+                                _index=index_map, zoom=zoom, area=area, _spatial=spatial_map)
+            if deck is not None:
+                with span('app.render', chart='map_accident'):
+                    st.pydeck_chart(deck)
+
+###############################################################################
+# Trace panel 
+###############################################################################
 
-    with tab1:  
-        st.plotly_chart(choropleth_graph(data_accident, year_filter, var_filter), 
-                        theme="streamlit", 
-                        use_container_width=True)
-    with tab2:  
-        map_accident(data_accident, state_filter, year_filter, var_filter)
+if tracing.ENABLED:
+    spans = collect()
+    with st.sidebar.expander('Tiempos de esta ejecución'):
+        st.metric('Tiempo total (ms)', round(sum(item['ms'] for item in spans if item['depth'] == 0), 1))
+        st.dataframe([{'Etapa': '  ' * item['depth'] + item['span'], 'ms': item['ms'], 
+                       'Filas': item.get('rows'), 'Caché': item.get('cache')} for item in spans])
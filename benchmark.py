@@ -0,0 +1,464 @@
+"""
+Este script mide el rendimiento del proceso de ETL y de las consultas del dashboard, usando datos
+sintéticos con la misma estructura de los archivos accident_20xx.csv de la NHTSA.
+
+Los datos se generan con los dominios de códigos de rename.py y con los códigos de condados y ciudades
+del archivo FRPP_GLC_-_United_States_may_9__2023.xlsx, en un directorio de trabajo independiente de data/.
+Cada año incluye algunas filas que no cumplen las reglas de calidad de rename.py, y el script termina con
+error si el ETL no encuentra exactamente esas filas.
+Su tamaño se define como múltiplo (--scale 1, 10, 100) del número de accidentes de un año real.
+
+Se mide cada etapa del ETL (lectura, transformación, exportación y cubo) sobre un año, el ETL completo
+y su ejecución incremental sin cambios, y cada función de graphs.py con combinaciones de filtros
+representativas, sin usar sus cachés. Para cada medición se reporta el tiempo, la memoria máxima durante
+la etapa (RSS de este proceso y de sus procesos hijos) y las filas procesadas por segundo, en formato JSON.
+Con la opción --baseline se comparan los tiempos y la memoria con los de una ejecución anterior, y el
+script termina con error si alguno empeora más de la tolerancia (--tolerance)
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+GLC_FILE = 'FRPP_GLC_-_United_States_may_9__2023.xlsx'
+
+# Número aproximado de accidentes por año en los archivos de la NHTSA (2011-2021)
+ROWS_PER_YEAR = 33500
+YEARS = range(2011, 2022)
+
+# Filas que no cumplen una regla de calidad de rename.py, que se escriben al inicio de cada año para
+# verificar la validación del ETL. Cada una genera exactamente una infracción de la regla indicada
+INVALID_ROWS = {'Fatals: range': {'FATALS': 0},
+                'latitude: sentinel': {'LATITUDE': 77.7777},
+                'longitud: sentinel': {'LONGITUD': 888.8888},
+                'latitude: bounds': {'LATITUDE': 10.0},
+                'Date: invalid': {'MONTH': 2, 'DAY': 30},
+                'Climatic condition: domain': {'WEATHER': 42, 'WEATHERNAME': 'Volcanic Ash'}}
+
+logger = logging.getLogger(__name__)
+
+def generate_fars(path, city_names, scale=1.0, years=YEARS, seed=0):
+    """
+    Writes synthetic accident_20xx.csv files with the columns and code domains of the FARS files.
+
+    As in the real files, the files of 2011-2014 only contain the codes, and the later ones also
+    contain the name columns (STATENAME, MONTHNAME, ...). The first rows of each file break the
+    data quality rules of INVALID_ROWS, one rule per row.
+
+    Args:
+        path (str): The directory where the CSV files are written.
+        city_names (pandas.DataFrame): The city lookup returned by common.load_glc, used to draw
+            valid (STATE, COUNTY, CITY) codes.
+        scale (float, optional): The number of rows of each file, as a multiple of ROWS_PER_YEAR. Default is 1.
+        years (iterable, optional): The years of the files. Default is 2011-2021.
+        seed (int, optional): The seed of the random generator. Default is 0.
+
+    Returns:
+        int: The total number of rows written.
+    """
+    from rename import state_name, dayweek_name, month_name, weather, route, lgt_cond
+
+    rng = np.random.default_rng(seed)
+    places = city_names[city_names['STATE'].isin(list(state_name))].reset_index(drop=True)
+    n = int(ROWS_PER_YEAR * scale)
+    os.makedirs(path, exist_ok=True)
+    for year in years:
+        place = places.iloc[rng.integers(0, len(places), n)]
+        data = pd.DataFrame({
+            'ST_CASE': np.arange(n),
+            'STATE': place['STATE'].to_numpy(),
+            'COUNTY': place['COUNTY'].to_numpy(),
+            'CITY': np.where(rng.random(n) < 0.3, 0, place['CITY'].to_numpy()),
+            'PEDS': rng.integers(0, 3, n),
+            'PERNOTMVIT': rng.integers(0, 3, n),
+            'VE_TOTAL': rng.integers(1, 5, n),
+            'VE_FORMS': rng.integers(1, 4, n),
+            'PVH_INVL': rng.integers(0, 2, n),
+            'PERSONS': rng.integers(1, 6, n),
+            'PERMVIT': rng.integers(1, 6, n),
+            'MONTH': rng.choice(list(month_name), n),
+            'DAY': rng.integers(1, 29, n),
+            'DAY_WEEK': rng.choice(list(dayweek_name), n),
+            'YEAR': year,
+            'HOUR': rng.choice([*range(24), 99], n),
+            'ROUTE': rng.choice(list(route), n),
+            'LATITUDE': rng.uniform(25, 48, n).round(4),
+            'LONGITUD': rng.uniform(-124, -70, n).round(4),
+            'LGT_COND': rng.choice(list(lgt_cond), n),
+            'WEATHER': rng.choice(list(weather), n),
+            'FATALS': rng.integers(1, 4, n)})
+        invalid = pd.DataFrame(list(INVALID_ROWS.values()))
+        codes = [col for col in invalid.columns if not col.endswith('NAME')]
+        data.loc[invalid.index, codes] = invalid[codes].combine_first(data.loc[invalid.index, codes])
+        if year > 2014:
+            for col, names in [('STATE', state_name), ('DAY_WEEK', dayweek_name), ('MONTH', month_name),
+                               ('WEATHER', weather), ('ROUTE', route), ('LGT_COND', lgt_cond)]:
+                data[col + 'NAME'] = data[col].map(names)
+            names = [col for col in invalid.columns if col.endswith('NAME')]
+            data.loc[invalid.index, names] = invalid[names].combine_first(data.loc[invalid.index, names])
+        data.to_csv(os.path.join(path, f'accident_{year}.csv'), index=False, encoding='cp1252')
+    return n * len(years)
+
+def check_quality(manifest_path, years):
+    """
+    Checks that the ETL found exactly the rows of INVALID_ROWS in each year.
+
+    Args:
+        manifest_path (str): The path of the manifest written by the ETL.
+        years (iterable): The years of the synthetic files.
+
+    Raises:
+        RuntimeError: If the number of rows that break a rule of INVALID_ROWS is not one in every year.
+    """
+    from common import read_manifest
+
+    violations = read_manifest(manifest_path).get('quality', {}).get('violations', {})
+    wrong = {f'{year} {rule}': violations.get(str(year), {}).get(rule, 0)
+             for year in years for rule in INVALID_ROWS
+             if violations.get(str(year), {}).get(rule, 0) != 1}
+    if wrong:
+        raise RuntimeError(f'La validación del ETL no encontró las filas inválidas esperadas: {wrong}')
+
+def check_snapshot(data):
+    """
+    Checks that the columns loaded by common.open_snapshot are still read-only views of the mapped
+    file after selecting rows, as the graphs do, and were not copied into the memory of the process.
+
+    Args:
+        data (pandas.DataFrame): The data returned by open_snapshot.
+
+    Raises:
+        RuntimeError: If a numeric column or the codes of a categorical column are writeable.
+    """
+    data.take(np.arange(min(len(data), 10)))
+    copied = [col for col in data.columns
+              if (data[col].array.codes if isinstance(data[col].dtype, pd.CategoricalDtype)
+                  else data[col].to_numpy()).flags.writeable]
+    if copied:
+        raise RuntimeError(f'Columnas del snapshot copiadas en la memoria del proceso: {copied}')
+
+def tree_rss():
+    """
+    Returns the resident memory, in bytes, of this process and of its running child processes.
+
+    The memory is read from the /proc file system, so it is only available on Linux.
+
+    Returns:
+        int or None: The resident memory, or None if it cannot be read.
+    """
+    if not os.path.exists('/proc/self/statm'):
+        return None
+    page = os.sysconf('SC_PAGE_SIZE')
+    pids = [os.getpid()]
+    total = 0
+    while pids:
+        pid = pids.pop()
+        # Los procesos hijos pueden terminar mientras se recorren
+        try:
+            with open(f'/proc/{pid}/statm') as file:
+                total += int(file.read().split()[1]) * page
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as file:
+                    pids.extend(int(child) for child in file.read().split())
+        except OSError:
+            pass
+    return total
+
+class PeakRss:
+    """
+    Samples the resident memory of the process tree (see tree_rss) on a thread while a stage runs.
+
+    Unlike the peak memory of the process reported by the operating system, which never decreases,
+    the peak of each stage is measured from the memory at its start.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, tree_rss())
+
+    def __enter__(self):
+        self.start = self.peak = tree_rss()
+        if self.start is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, tree_rss())
+        return False
+
+def measure(results, name, func, rows, repeat=1):
+    """
+    Runs a function, records its best wall time, its peak memory and the rows per second.
+
+    Args:
+        results (dict): The results, updated with the measure.
+        name (str): The name of the measure.
+        func (callable): The function to run, without arguments.
+        rows (int or None): The number of rows processed by each run. None if it is not known.
+        repeat (int, optional): The number of runs. Default is 1.
+
+    Returns:
+        The value returned by the last run.
+    """
+    times = []
+    samplers = []
+    for _ in range(repeat):
+        with PeakRss() as sampler:
+            start = time.perf_counter()
+            value = func()
+            times.append(time.perf_counter() - start)
+        samplers.append(sampler)
+    wall = min(times)
+    peak = max((sampler.peak for sampler in samplers if sampler.peak is not None), default=None)
+    growth = max((sampler.peak - sampler.start for sampler in samplers if sampler.peak is not None), default=None)
+    results[name] = {'wall_s': round(wall, 6),
+                     'peak_rss_mb': round(peak / 2**20, 1) if peak is not None else None,
+                     'rss_growth_mb': round(growth / 2**20, 1) if growth is not None else None,
+                     'rows': int(rows) if rows is not None else None,
+                     'rows_per_s': round(rows / wall, 1) if rows and wall > 0 else None}
+    logger.info('%-45s %10.4f s %12.0f filas/s %8.1f MB', name, wall, results[name]['rows_per_s'] or 0,
+                results[name]['peak_rss_mb'] or 0)
+    return value
+
+def bench_etl(results, workers=None, max_memory=1024):
+    """
+    Measures each stage of the ETL on one year, the full ETL and an incremental run without changes.
+    """
+    import etl_process
+    from common import load_glc, list_year_files, read_chunks, write_dataset, aggregate_cube
+    from rename import raw_dtypes, cat_study, vars_study
+
+    path_accident = os.path.join(etl_process.PATH, 'accident_data')
+    files = list_year_files(path_accident)
+    year, item = next(iter(files.items()))
+    county_names, city_names = measure(results, 'etl.load_glc',
+                                       lambda: load_glc(etl_process.GLC_PATH, etl_process.GLC_CACHE_PATH), 0)
+
+    rows = sum(1 for _ in open(os.path.join(path_accident, item), encoding='ISO-8859-1')) - 1
+    raw = measure(results, 'etl.read_csv',
+                  lambda: next(read_chunks(item, path_accident, raw_dtypes, dtype=raw_dtypes, chunksize=rows)), rows)
+    data, _, _ = measure(results, 'etl.transform',
+                      lambda: etl_process.transform_chunk(raw.copy(), county_names, city_names), rows)
+
+    tmp_path = 'bench_tmp'
+    def write():
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        write_dataset(data, tmp_path)
+    measure(results, 'etl.write_dataset', write, rows)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    measure(results, 'etl.aggregate_cube', lambda: aggregate_cube(data, cat_study, vars_study), rows)
+
+    total = rows * len(files)
+    measure(results, 'etl.full', lambda: etl_process.main(workers=workers, max_memory=max_memory), total)
+    check_quality(etl_process.MANIFEST_PATH, files)
+    measure(results, 'etl.incremental_noop',
+            lambda: etl_process.main(workers=workers, incremental=True, max_memory=max_memory), total)
+
+def selection_size(data, state_filter, year_filter):
+    """
+    Returns the number of accidents selected by a state and year filter of the dashboard.
+
+    Args:
+        data (pandas.DataFrame): The accident data.
+        state_filter (str or list): The state(s) selected.
+        year_filter (str or list): The year(s) selected, as strings or integers.
+
+    Returns:
+        int: The number of selected accidents.
+    """
+    states = [state_filter] if isinstance(state_filter, str) else list(state_filter)
+    years = [year_filter] if isinstance(year_filter, (str, int)) else list(year_filter)
+    mask = data['State'].isin(states) & data['Year'].isin([int(year) for year in years])
+    return int(mask.sum())
+
+def bench_queries(results, rows, repeat=3):
+    """
+    Measures the loading of the dataset, its indexes and each function of graphs.py, without their caches.
+    """
+    import etl_process
+    import graphs
+    import queries
+    from common import (read_dataset, open_snapshot, read_cube, build_row_index, build_spatial_index,
+                        build_state_totals, query_radius)
+    from rename import cat_study, vars_study, code_state
+
+    columns = ['State', 'Year', 'latitude', 'longitud'] + vars_study
+    data = measure(results, 'load.dataset', lambda: read_dataset(etl_process.DATASET_PATH, columns=columns), rows, repeat)
+    snapshot = measure(results, 'load.snapshot', lambda: open_snapshot(etl_process.DATASET_PATH, columns=columns), rows, repeat)
+    check_snapshot(snapshot)
+    cube = measure(results, 'load.cube', lambda: read_cube(etl_process.CUBE_PATH, cat_study), rows, repeat)
+    index = measure(results, 'index.rows', lambda: build_row_index(data), rows, repeat)
+    spatial = measure(results, 'index.spatial', lambda: build_spatial_index(data), rows, repeat)
+    totals = measure(results, 'index.state_totals',
+                     lambda: build_state_totals(cube['State'], ['Total accidents'] + vars_study, code_state), rows, repeat)
+    measure(results, 'query.radius_50km', lambda: query_radius(spatial, -97.7, 30.3, 50), rows, repeat)
+
+    # Las funciones se llaman sin sus cachés en memoria y en disco
+    queries.execute = inspect.unwrap(queries.execute)
+    count_graph = inspect.unwrap(graphs.count_graph)
+    sum_stats_study = inspect.unwrap(graphs.sum_stats_study)
+    scatter_graph = inspect.unwrap(graphs.scatter_graph)
+    choropleth_graph = inspect.unwrap(graphs.choropleth_graph)
+    map_accident = inspect.unwrap(graphs.map_accident)
+    trend_graph = inspect.unwrap(graphs.trend_graph)
+    heatmap_graph = inspect.unwrap(graphs.heatmap_graph)
+
+    states = sorted(data['State'].astype(str).unique())
+    years = [str(year) for year in sorted(data['Year'].unique())]
+    state = 'Texas' if 'Texas' in states else states[0]
+    filters = {'all_states.all_years': (states, years),
+               'one_state.all_years': (state, years),
+               'all_states.one_year': (states, years[-1]),
+               'one_state.one_year': (state, years[-1])}
+    # Las filas de cada figura son los accidentes seleccionados por sus filtros
+    for name, (state_filter, year_filter) in filters.items():
+        selected = selection_size(data, state_filter, year_filter)
+        measure(results, f'graphs.count_graph.Year.{name}',
+                lambda: count_graph(cube, None, state_filter, [int(year) for year in years], 'Year'),
+                selection_size(data, state_filter, years), repeat)
+        measure(results, f'graphs.count_graph.Month.{name}',
+                lambda: count_graph(cube, None, state_filter, year_filter, 'Month'), selected, repeat)
+        measure(results, f'graphs.count_graph.City.{name}',
+                lambda: count_graph(cube, None, state_filter, year_filter, 'City'), selected, repeat)
+        measure(results, f'graphs.sum_stats_study.County.{name}',
+                lambda: sum_stats_study(cube, None, state_filter, year_filter, vars_study[0], 'County'), selected, repeat)
+        measure(results, f'graphs.trend_graph.month.{name}',
+                lambda: trend_graph(cube, None, state_filter, year_filter, vars_study[0], 'month'), selected, repeat)
+        measure(results, f'graphs.heatmap_graph.{name}',
+                lambda: heatmap_graph(cube, None, state_filter, year_filter, 'Total accidents'), selected, repeat)
+        measure(results, f'graphs.scatter_graph.{name}',
+                lambda: scatter_graph(data, None, year_filter, state_filter,
+                                      vars_study[0], vars_study[1], vars_study[2], _index=index), selected, repeat)
+        measure(results, f'graphs.map_accident.{name}',
+                lambda: map_accident(data, None, state_filter, year_filter, vars_study[0],
+                                     _index=index, area=(-97.7, 30.3, 200), _spatial=spatial), selected, repeat)
+    for name, year_filter in [('all_years', years), ('one_year', years[-1])]:
+        selected = selection_size(data, states, year_filter)
+        measure(results, f'graphs.choropleth_graph.{name}',
+                lambda: choropleth_graph(totals, None, year_filter, vars_study[0]), selected, repeat)
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the wall times and the peak memory of the results with those of a baseline.
+
+    Args:
+        results (dict): The measures of this run.
+        baseline (dict): The measures of the baseline run.
+        tolerance (float): The allowed relative increase of the wall time and of the peak memory, e.g. 0.2 for 20%.
+
+    Returns:
+        dict: The ratio between the wall time of this run and the baseline for each measure
+            present in both, and the names of the measures that exceed the tolerance, and the
+            same for the peak memory (rss_ratios and rss_regressions).
+    """
+    def ratios(metric):
+        return {name: round(measure[metric] / baseline[name][metric], 3)
+                for name, measure in results.items()
+                if measure.get(metric) is not None and (baseline.get(name) or {}).get(metric)}
+
+    wall = ratios('wall_s')
+    rss = ratios('peak_rss_mb')
+    return {'ratios': wall,
+            'regressions': sorted(name for name, ratio in wall.items() if ratio > 1 + tolerance),
+            'rss_ratios': rss,
+            'rss_regressions': sorted(name for name, ratio in rss.items() if ratio > 1 + tolerance)}
+
+def main(scale=1.0, workdir='bench_data', output=None, baseline=None, tolerance=0.2,
+         workers=None, max_memory=1024, repeat=3, keep=False):
+
+    # Se preparan los datos sintéticos en el directorio de trabajo, con la misma estructura de data/
+    workdir = os.path.abspath(workdir)
+    output = os.path.abspath(output) if output else None
+    baseline = os.path.abspath(baseline) if baseline else None
+    sys.path.insert(0, ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(os.path.join(workdir, 'data', 'additional_data'))
+    shutil.copy(os.path.join(ROOT, 'data', 'additional_data', GLC_FILE),
+                os.path.join(workdir, 'data', 'additional_data', GLC_FILE))
+    os.chdir(workdir)
+
+    import etl_process
+    from common import load_glc
+    _, city_names = load_glc(etl_process.GLC_PATH, etl_process.GLC_CACHE_PATH)
+    start = time.perf_counter()
+    rows = generate_fars(os.path.join(etl_process.PATH, 'accident_data'), city_names, scale=scale)
+    logger.info('Datos sintéticos: %d filas (escala %s) en %.1f s', rows, scale, time.perf_counter() - start)
+    shutil.rmtree(etl_process.GLC_CACHE_PATH)
+
+    results = {}
+    bench_etl(results, workers=workers, max_memory=max_memory)
+    bench_queries(results, rows, repeat=repeat)
+
+    report = {'scale': scale,
+              'rows': rows,
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'cpus': os.cpu_count(),
+              'results': results}
+    if baseline:
+        with open(baseline, encoding='utf-8') as file:
+            report['comparison'] = compare(results, json.load(file)['results'], tolerance)
+        for name in report['comparison']['regressions']:
+            logger.warning('Regresión en %s: %.2fx el tiempo de referencia',
+                           name, report['comparison']['ratios'][name])
+        for name in report['comparison']['rss_regressions']:
+            logger.warning('Regresión de memoria en %s: %.2fx la memoria máxima de referencia',
+                           name, report['comparison']['rss_ratios'][name])
+    if output:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+    os.chdir(ROOT)
+    if not keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark del ETL y de las consultas del dashboard con datos sintéticos')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Tamaño de cada año como múltiplo del número real de accidentes (1, 10, 100)')
+    parser.add_argument('--workdir', default='bench_data',
+                        help='Directorio de trabajo para los datos sintéticos')
+    parser.add_argument('--output', default=None,
+                        help='Archivo JSON donde se guardan los resultados')
+    parser.add_argument('--baseline', default=None,
+                        help='Archivo JSON de una ejecución anterior con el que se comparan los tiempos')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Aumento relativo del tiempo o de la memoria a partir del cual se reporta una regresión')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Número de procesos del ETL (por defecto uno por CPU)')
+    parser.add_argument('--max-memory', type=int, default=1024,
+                        help='Límite aproximado de memoria, en MB, para los bloques del ETL')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Número de repeticiones de cada consulta (se reporta el mejor tiempo)')
+    parser.add_argument('--keep', action='store_true',
+                        help='Conserva el directorio de trabajo al terminar')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    report = main(scale=args.scale, workdir=args.workdir, output=args.output, baseline=args.baseline,
+                  tolerance=args.tolerance, workers=args.workers, max_memory=args.max_memory,
+                  repeat=args.repeat, keep=args.keep)
+    comparison = report.get('comparison', {})
+    if comparison.get('regressions') or comparison.get('rss_regressions'):
+        sys.exit(1)
@@ -1,9 +1,34 @@
+import calendar
+import codecs
+import functools
+import hashlib
+import inspect
+import json
 import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import gridspec
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
 import streamlit as st
+from tracing import annotate, traced
+
+# Número de valores de cada lista de los más frecuentes (ver build_top_lists)
+TOP_LIST_SIZE = 50
+
+# Niveles del almacén de series de tiempo y sus claves, además de State y Year (ver aggregate_rollup)
+ROLLUP_LEVELS = {'Day': ['Month', 'Day of month'], 'Hour': ['Day of week', 'Hour']}
+
+# Número de cada mes a partir de su nombre
+MONTH_NUMBERS = {name: number for number, name in enumerate(calendar.month_name) if name}
+
+# Radio medio de la Tierra, en kilómetros, con el que se calculan las distancias entre coordenadas
+EARTH_RADIUS_KM = 6371.0088
 
 @st.cache_data
 def load_data_pickle(file_path):
@@ -19,10 +44,996 @@ def load_data_pickle(file_path):
     data = pd.read_pickle(file_path) 
     return data
 
+def write_dataset(data, path, partition_cols=('Year',), part='0'):
+    """
+    Writes data as a columnar Arrow IPC (Feather v2) dataset, split in hive-style partitions.
+
+    Each partition is stored as uncompressed files under a directory such as Year=2021/,
+    so it can be memory-mapped and read without decoding. Files already in the partitions
+    are kept, so a partition can be written in several parts; delete its directory first
+    to replace it.
+
+    Args:
+        data (pandas.DataFrame): The data to write.
+        path (str): The path to the dataset directory.
+        partition_cols (tuple, optional): The columns used to split the data. Default is ('Year',).
+            ('Year', 'State') is also supported.
+        part (str, optional): The name of the part, unique within each partition. Default is '0'.
+
+    Returns:
+        None
+    """
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    # Categorical columns use the same index width in every partition, so partitions written
+    # in different runs share one schema
+    table = table.cast(pa.schema([pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered))
+                                  if pa.types.is_dictionary(field.type) else field
+                                  for field in table.schema], metadata=table.schema.metadata))
+    ds.write_dataset(table, path,
+                     format='ipc',
+                     partitioning=list(partition_cols),
+                     partitioning_flavor='hive',
+                     basename_template=f'part-{part}-{{i}}.arrow',
+                     existing_data_behavior='overwrite_or_ignore')
+
+@traced()
+def read_dataset(path, columns=None, years=None, states=None):
+    """
+    Reads a dataset written by write_dataset, memory-mapping its files.
+
+    Only the requested columns are read, and partitions that do not match the year or
+    state filters are skipped without being opened.
+
+    Args:
+        path (str): The path to the dataset directory.
+        columns (list, optional): The columns to read. If not provided, all columns are read.
+        years (list, optional): The years to keep. If not provided, all years are kept.
+        states (list, optional): The states to keep. If not provided, all states are kept.
+
+    Returns:
+        pandas.DataFrame: The loaded data.
+    """
+    dataset = ds.dataset(path, format='ipc', partitioning='hive',
+                         filesystem=fs.LocalFileSystem(use_mmap=True))
+    filters = None
+    if years is not None:
+        filters = ds.field('Year').isin([int(item) for item in years])
+    if states is not None:
+        state_filter = ds.field('State').isin(list(states))
+        filters = state_filter if filters is None else filters & state_filter
+    table = dataset.to_table(columns=columns, filter=filters)
+    annotate(rows=table.num_rows)
+    return table.to_pandas()
+
+def dataset_version(path, manifest='_manifest.json'):
+    """
+    Computes an identifier of the current content of a dataset directory.
+
+    The identifier is the hash of the manifest written by the ETL, which changes whenever
+    a source file is processed again. If there is no manifest, the name, size and
+    modification time of every file in the directory are hashed instead.
+
+    Args:
+        path (str): The path to the dataset directory.
+        manifest (str, optional): The name of the manifest file in the directory. Default is '_manifest.json'.
+
+    Returns:
+        str: A short hexadecimal identifier.
+    """
+    digest = hashlib.sha256()
+    manifest_path = os.path.join(path, manifest)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'rb') as file:
+            digest.update(file.read())
+    else:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f'{os.path.relpath(os.path.join(root, name), path)}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()[:16]
+
+def _codes_type(size):
+    """
+    Returns the integer type pandas uses for the codes of a categorical with the given number of categories.
+    """
+    if size < np.iinfo(np.int8).max:
+        return pa.int8()
+    if size < np.iinfo(np.int16).max:
+        return pa.int16()
+    return pa.int32()
+
+def snapshot_path(path, version):
+    """
+    Returns the path to the snapshot file of a version of a dataset (see write_snapshot).
+
+    The names starting with an underscore are not part of the dataset.
+    """
+    return os.path.join(path, f'_snapshot-{version}.arrow')
+
+@traced()
+def write_snapshot(path, version):
+    """
+    Writes all the columns of a dataset as a single uncompressed Arrow IPC file, which the
+    processes of the dashboard memory-map with open_snapshot.
+
+    The columns are stored as one contiguous chunk each, with one dictionary per categorical
+    column and codes of the width used by pandas, so they can be converted to a pandas DataFrame
+    without copying them. The file is named after the version of the dataset and written to a
+    temporary file first, so the processes that read it never see it half written. The files of
+    previous versions are then removed from the directory; the processes that still have one of
+    them memory-mapped keep reading it, since the operating system frees a removed file only when
+    its last mapping is closed (on Windows, a file that is still open is not removed, and its
+    removal is retried on the next write).
+
+    Args:
+        path (str): The path to the dataset directory.
+        version (str): The version of the dataset (see dataset_version).
+
+    Returns:
+        str: The path to the file.
+    """
+    file_path = snapshot_path(path, version)
+    if not os.path.exists(file_path):
+        dataset = ds.dataset(path, format='ipc', partitioning='hive',
+                             filesystem=fs.LocalFileSystem(use_mmap=True))
+        table = dataset.to_table().unify_dictionaries().combine_chunks()
+        fields = [pa.field(field.name, pa.dictionary(_codes_type(len(table[field.name].chunk(0).dictionary)
+                                                                 if table.num_rows else 0),
+                                                     field.type.value_type, field.type.ordered))
+                  if pa.types.is_dictionary(field.type) else field
+                  for field in table.schema]
+        table = table.cast(pa.schema(fields, metadata=table.schema.metadata))
+        annotate(rows=table.num_rows)
+
+        tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, file_path)
+
+    for entry in os.scandir(path):
+        if re.fullmatch(r'_snapshot-\w+\.arrow', entry.name) and entry.path != file_path:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    return file_path
+
+def _categorical(array):
+    """
+    Converts a dictionary column of a memory-mapped table into a pandas Categorical whose codes are a
+    view of the mapped file, which pyarrow would otherwise copy. Returns None for any other column.
+    """
+    if array.num_chunks == 1 and pa.types.is_dictionary(array.type) and array.null_count == 0:
+        chunk = array.chunk(0)
+        codes = chunk.indices.to_numpy(zero_copy_only=True)
+        dtype = pd.CategoricalDtype(chunk.dictionary.to_pandas(), ordered=chunk.type.ordered)
+        return pd.Categorical.from_codes(codes, dtype=dtype)
+    return None
+
+@traced()
+def open_snapshot(path, columns=None, version=None):
+    """
+    Loads the columns of a dataset from its snapshot file (see write_snapshot), memory-mapping it.
+
+    The values stay in the mapped file, which the operating system shares between all the processes
+    that open it, so several Streamlit processes on one host use the memory of a single copy of
+    the data, and a new process starts without reading or decoding it. If the file of the version
+    does not exist yet, it is written first.
+
+    The returned DataFrame is a read-only view of the file: each numeric column is its own block
+    over the mapped values (pandas would copy them when joining the columns of the same type into
+    one block), and each categorical column is built from the mapped codes.
+
+    Args:
+        path (str): The path to the dataset directory.
+        columns (list, optional): The columns to read. If not provided, all columns are read.
+        version (str, optional): The version of the dataset. Default is its current version (see dataset_version).
+
+    Returns:
+        pandas.DataFrame: The loaded data, with the columns in the requested order.
+    """
+    version = version or dataset_version(path)
+    file_path = snapshot_path(path, version)
+    if not os.path.exists(file_path):
+        write_snapshot(path, version)
+    table = pa.ipc.open_file(pa.memory_map(file_path)).read_all()
+    if columns is not None:
+        table = table.select(list(columns))
+    annotate(rows=table.num_rows)
+    categoricals = {name: _categorical(array) for name, array in zip(table.column_names, table.columns)}
+    categoricals = {name: values for name, values in categoricals.items() if values is not None}
+    others = table.drop(list(categoricals)).to_pandas(split_blocks=True)
+    data = pd.DataFrame({name: categoricals[name] if name in categoricals else others[name]
+                         for name in table.column_names},
+                        index=pd.RangeIndex(table.num_rows), copy=False)
+
+    # pandas junta los bloques del mismo tipo la primera vez que se seleccionan filas (p. ej. con take),
+    # lo que copiaría los valores en cada proceso, por lo que el DataFrame se marca como ya consolidado
+    data._mgr._is_consolidated = True
+    data._mgr._known_consolidated = True
+    return data
+
+def _freeze(value):
+    """
+    Converts a cache key argument into a hashable value, turning lists, sets and dicts into tuples.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(item) for item in value))
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _cache_key(signature, args, kwargs):
+    """
+    Builds the cache key of a call from its arguments, leaving out the parameters whose name starts with an underscore.
+    """
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return tuple((name, _freeze(value)) for name, value in bound.arguments.items()
+                 if not name.startswith('_'))
+
+def cache_result(maxsize=64):
+    """
+    Caches the results of a function in memory, keyed only by its small arguments.
+
+    As in Streamlit, the parameters whose name starts with an underscore (the data frames
+    and indexes) are not part of the key, so they are never hashed. The functions must
+    receive instead a version of the data (see dataset_version) in their other arguments.
+    The least recently used results are evicted once the cache holds maxsize of them.
+
+    The decorated function exposes cache_info(), with the hits, misses and size of the
+    cache, and cache_clear(). The cached results are shared by every session of the
+    Streamlit server, so they must be treated as read-only.
+
+    Args:
+        maxsize (int, optional): The maximum number of results kept. Default is 64.
+
+    Returns:
+        function: The decorator.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        cache = OrderedDict()
+        stats = {'hits': 0, 'misses': 0}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _cache_key(signature, args, kwargs)
+            with lock:
+                if key in cache:
+                    cache.move_to_end(key)
+                    stats['hits'] += 1
+                    annotate(cache='hit')
+                    return cache[key]
+                stats['misses'] += 1
+            annotate(cache='miss')
+            result = func(*args, **kwargs)
+            with lock:
+                cache[key] = result
+                cache.move_to_end(key)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        def cache_info():
+            with lock:
+                return {**stats, 'size': len(cache), 'maxsize': maxsize}
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats.update(hits=0, misses=0)
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+def disk_cache(path, max_bytes=512 * 2**20, dumps=None, loads=None):
+    """
+    Caches the results of a function as files, shared by every process of the host.
+
+    The key is built as in cache_result, so the functions must receive a version of the data
+    in their arguments. Each result is written to a file named after the hash of the function
+    name and the key, through a temporary file, so that concurrent processes never read a
+    partial result. A hit updates the modification time of the file, and when the files of
+    the directory exceed max_bytes, the least recently used ones are deleted.
+
+    The decorated function exposes cache_info(), with the hits and misses of the process
+    and the files and bytes in the directory. The decorator keeps the decorated functions in
+    its functions attribute, keyed by their name, so their statistics can be read even when
+    other decorators wrap them.
+
+    Args:
+        path (str): The directory of the cached files.
+        max_bytes (int, optional): The maximum size of the files in the directory. Default is 512 MB.
+        dumps (function, optional): Converts a result to a string. Default is json.dumps.
+        loads (function, optional): Converts a string back to a result. Default is json.loads.
+
+    Returns:
+        function: The decorator.
+    """
+    dumps = dumps or json.dumps
+    loads = loads or json.loads
+    
+    def decorator(func):
+        signature = inspect.signature(func)
+        name = f'{func.__module__}.{func.__qualname__}'
+        stats = {'hits': 0, 'misses': 0}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = repr((name, _cache_key(signature, args, kwargs)))
+            file_path = os.path.join(path, hashlib.sha256(key.encode()).hexdigest() + '.json')
+            try:
+                with open(file_path, encoding='utf-8') as file:
+                    result = loads(file.read())
+                os.utime(file_path)
+                stats['hits'] += 1
+                annotate(disk_cache='hit')
+                return result
+            except (OSError, ValueError):
+                stats['misses'] += 1
+                annotate(disk_cache='miss')
+            result = func(*args, **kwargs)
+            os.makedirs(path, exist_ok=True)
+            tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                file.write(dumps(result))
+            os.replace(tmp_path, file_path)
+            evict_files(path, max_bytes)
+            return result
+
+        def cache_info():
+            files = [entry.stat().st_size for entry in os.scandir(path) 
+                     if entry.name.endswith('.json')] if os.path.isdir(path) else []
+            return {**stats, 'files': len(files), 'bytes': sum(files), 'max_bytes': max_bytes}
+
+        wrapper.cache_info = cache_info
+        decorator.functions[func.__name__] = wrapper
+        return wrapper
+
+    decorator.functions = {}
+    return decorator
+
+def evict_files(path, max_bytes):
+    """
+    Deletes the least recently used files of a cache directory until their size is at most max_bytes.
+
+    Args:
+        path (str): The directory of the cached files.
+        max_bytes (int): The maximum size of the files in the directory.
+
+    Returns:
+        int: The number of deleted files.
+    """
+    files = []
+    for entry in os.scandir(path):
+        if entry.name.endswith('.json'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    deleted = 0
+    for _, size, file_path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(file_path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return deleted
+
+@st.cache_resource
+def load_data_arrow(file_path, columns=None, years=None, states=None, version=None):
+    """
+    Loads data from a dataset written by write_dataset.
+
+    Without year or state filters, the data is a view of the snapshot file of the dataset
+    (see open_snapshot), shared by every Streamlit process on the host. The returned DataFrame
+    is also shared by every session of the Streamlit server, so it must be treated as read-only.
+
+    Args:
+        file_path (str): The path to the dataset directory.
+        columns (list, optional): The columns to read. If not provided, all columns are read.
+        years (list, optional): The years to keep. If not provided, all years are kept.
+        states (list, optional): The states to keep. If not provided, all states are kept.
+        version (str, optional): The version of the dataset (see dataset_version). It is only
+            used as part of the cache key, so that a new version is loaded again.
+
+    Returns:
+        pandas.DataFrame: The loaded data.
+    """
+    # Sin filtros, los datos se leen de la copia en memoria compartida por todos los procesos
+    if years is None and states is None:
+        return open_snapshot(file_path, columns=columns, version=version)
+    return read_dataset(file_path, columns=columns, years=years, states=states)
+
+@traced()
+def build_row_index(data, columns=('State', 'Year')):
+    """
+    Builds an index with the row positions of each value of the given columns.
+
+    For each value, the positions are stored as a sorted int32 array, so the rows of any
+    selection are obtained with set operations on those arrays instead of comparing
+    every row of the DataFrame.
+
+    Args:
+        data (pandas.DataFrame): The data to index.
+        columns (tuple, optional): The columns to index. Default is ('State', 'Year').
+
+    Returns:
+        dict: For each column, a dict with the row positions of each value.
+    """
+    index = {}
+    for col in columns:
+        codes, uniques = pd.factorize(data[col], sort=True)
+        order = np.argsort(codes, kind='stable').astype(np.int32)
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        index[col] = {value: order[bounds[i]:bounds[i + 1]] for i, value in enumerate(uniques.tolist())}
+    return index
+
+def select_rows(index, **filters):
+    """
+    Finds the row positions that match a selection of values, using an index built by build_row_index.
+
+    Args:
+        index (dict): The index returned by build_row_index.
+        **filters: The values to keep for each indexed column, e.g. State=['Texas'], Year=[2020, 2021].
+            A filter that includes every value of its column is skipped.
+
+    Returns:
+        numpy.ndarray or slice: The sorted positions of the matching rows, or slice(None)
+            if no filter restricts the selection.
+    """
+    selected = []
+    for col, values in filters.items():
+        postings = index[col]
+        values = set(values)
+        if values.issuperset(postings):
+            continue
+        rows = [postings[value] for value in values if value in postings]
+        selected.append(np.sort(np.concatenate(rows), kind='stable') if rows else np.empty(0, dtype=np.int32))
+    rows = slice(None)
+    for other in sorted(selected, key=len):
+        rows = intersect_rows(rows, other)
+    return rows
+
+def intersect_rows(rows, other):
+    """
+    Finds the row positions present in two selections.
+
+    Args:
+        rows (numpy.ndarray or slice): Sorted row positions, or slice(None) for all the rows.
+        other (numpy.ndarray or slice): Sorted row positions, or slice(None) for all the rows.
+
+    Returns:
+        numpy.ndarray or slice: The sorted positions present in both selections.
+    """
+    if isinstance(rows, slice):
+        return other
+    if isinstance(other, slice):
+        return rows
+    if len(other) < len(rows):
+        rows, other = other, rows
+    if len(other) == 0:
+        return other
+    pos = np.minimum(np.searchsorted(other, rows), len(other) - 1)
+    return rows[other[pos] == rows]
+
+@st.cache_resource
+def load_row_index(file_path, _data, columns=('State', 'Year'), version=None):
+    """
+    Builds the row index of the data loaded from a dataset, once per Streamlit server.
+
+    Args:
+        file_path (str): The path to the dataset directory, used as the cache key.
+        _data (pandas.DataFrame): The data loaded from file_path with load_data_arrow. It is not hashed.
+        columns (tuple, optional): The columns to index. Default is ('State', 'Year').
+        version (str, optional): The version of the dataset (see dataset_version), used as the cache key.
+
+    Returns:
+        dict: The index returned by build_row_index.
+    """
+    return build_row_index(_data, columns)
+
+@traced()
+def build_spatial_index(data, cell_size=0.1, longitude='longitud', latitude='latitude'):
+    """
+    Builds a grid index over the coordinates of the accidents.
+
+    The rows are sorted by the grid cell that contains them, and each cell keeps the range
+    of its rows in that order, so a query only reads the rows of the cells it overlaps.
+    Rows without coordinates are left out.
+
+    Args:
+        data (pandas.DataFrame): The data to index.
+        cell_size (float, optional): The side of the grid cells, in degrees. Default is 0.1.
+        longitude (str, optional): The column with the longitude. Default is 'longitud'.
+        latitude (str, optional): The column with the latitude. Default is 'latitude'.
+
+    Returns:
+        dict: The index, with the cell size, the sorted keys of the non-empty cells, the first
+            position of each cell and the rows with their coordinates, sorted by cell.
+    """
+    lon = data[longitude].to_numpy(dtype=np.float64, na_value=np.nan)
+    lat = data[latitude].to_numpy(dtype=np.float64, na_value=np.nan)
+    rows = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180))
+    keys = _cell_key(lon[rows], lat[rows], cell_size)
+    order = np.argsort(keys, kind='stable')
+    keys, rows = keys[order], rows[order].astype(np.int32)
+    cells, bounds = np.unique(keys, return_index=True)
+    return {'cell_size': cell_size,
+            'cells': cells,
+            'bounds': np.append(bounds, len(keys)),
+            'rows': rows,
+            'longitude': lon[rows],
+            'latitude': lat[rows]}
+
+def _cell_key(lon, lat, cell_size):
+    """
+    Computes the key of the grid cell of each coordinate.
+    """
+    ix = np.floor((np.asarray(lon) + 180) / cell_size).astype(np.int64)
+    iy = np.floor((np.asarray(lat) + 90) / cell_size).astype(np.int64)
+    return ix * (1 << 20) + iy
+
+def _bbox_candidates(index, min_lon, min_lat, max_lon, max_lat):
+    """
+    Finds the positions, in the index order, of the rows of the cells that overlap a bounding box.
+    """
+    cell_size = index['cell_size']
+    ix = np.arange(np.floor((min_lon + 180) / cell_size), np.floor((max_lon + 180) / cell_size) + 1, dtype=np.int64)
+    iy = np.arange(np.floor((min_lat + 90) / cell_size), np.floor((max_lat + 90) / cell_size) + 1, dtype=np.int64)
+    if len(ix) * len(iy) > len(index['cells']):
+        # La caja cubre más celdas de las que existen: se recorren las celdas no vacías
+        cx, cy = index['cells'] >> 20, index['cells'] & ((1 << 20) - 1)
+        found = np.flatnonzero((cx >= ix[0]) & (cx <= ix[-1]) & (cy >= iy[0]) & (cy <= iy[-1]))
+    else:
+        keys = (ix[:, None] * (1 << 20) + iy[None, :]).ravel()
+        pos = np.searchsorted(index['cells'], keys)
+        found = pos[(pos < len(index['cells'])) & (index['cells'][np.minimum(pos, len(index['cells']) - 1)] == keys)]
+    if len(found) == 0:
+        return np.empty(0, dtype=np.int64)
+    starts, ends = index['bounds'][found], index['bounds'][found + 1]
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+def query_bbox(index, min_lon, min_lat, max_lon, max_lat):
+    """
+    Finds the accidents inside a bounding box, such as the viewport of a map.
+
+    Args:
+        index (dict): The index returned by build_spatial_index.
+        min_lon (float): The west limit of the box.
+        min_lat (float): The south limit of the box.
+        max_lon (float): The east limit of the box.
+        max_lat (float): The north limit of the box.
+
+    Returns:
+        numpy.ndarray: The sorted positions of the rows inside the box.
+    """
+    pos = _bbox_candidates(index, min_lon, min_lat, max_lon, max_lat)
+    lon, lat = index['longitude'][pos], index['latitude'][pos]
+    inside = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+    return np.sort(index['rows'][pos[inside]])
+
+def query_radius(index, lon, lat, km):
+    """
+    Finds the accidents within a distance of a point.
+
+    Args:
+        index (dict): The index returned by build_spatial_index.
+        lon (float): The longitude of the point.
+        lat (float): The latitude of the point.
+        km (float): The distance, in kilometers.
+
+    Returns:
+        numpy.ndarray: The sorted positions of the rows within the distance.
+    """
+    return query_corridor(index, [(lon, lat)], km)
+
+def _unit_vectors(lon, lat):
+    """
+    Converts coordinates, in degrees, into unit vectors of the sphere, one per row.
+    """
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+def _angle(u, v):
+    """
+    Computes the angle, in radians, between unit vectors, accurate for small and large angles.
+    """
+    return np.arctan2(np.linalg.norm(np.cross(u, v), axis=-1), np.sum(u * v, axis=-1))
+
+def _arc_distance(lon, lat, a, b):
+    """
+    Computes the great-circle distance, in kilometers, from each coordinate to the shortest arc between two points.
+    """
+    p = _unit_vectors(lon, lat)
+    va, vb = _unit_vectors(*a), _unit_vectors(*b)
+    ends = np.minimum(_angle(p, va), _angle(p, vb))
+    normal = np.cross(va, vb)
+    if np.linalg.norm(normal) < 1e-12:
+        return ends * EARTH_RADIUS_KM
+    normal /= np.linalg.norm(normal)
+
+    # El punto más cercano del gran círculo está sobre el arco si su proyección queda entre a y b
+    side = p @ normal
+    q = p - side[:, None] * normal
+    inside = (np.cross(va, q) @ normal >= 0) & (np.cross(q, vb) @ normal >= 0)
+    return np.where(inside, np.abs(np.arcsin(np.clip(side, -1, 1))), ends) * EARTH_RADIUS_KM
+
+def _cap_bbox(lon, lat, km):
+    """
+    Computes the bounding box (min_lon, min_lat, max_lon, max_lat) of the points within a
+    great-circle distance of each coordinate. The longitudes may extend beyond ±180.
+    """
+    radius = np.degrees(km / EARTH_RADIUS_KM)
+    min_lat, max_lat = np.min(lat) - radius, np.max(lat) + radius
+    if min_lat <= -90 or max_lat >= 90:
+        return -180.0, max(min_lat, -90.0), 180.0, min(max_lat, 90.0)
+    dlon = np.degrees(np.arcsin(np.sin(km / EARTH_RADIUS_KM) / np.cos(np.radians(np.abs(lat)))))
+    return float(np.min(lon - dlon)), float(min_lat), float(np.max(lon + dlon)), float(max_lat)
+
+def query_corridor(index, points, km):
+    """
+    Finds the accidents within a distance of a route, given as a sequence of points.
+
+    The distances are great-circle distances to the shortest arc between each pair of
+    consecutive points. The grid index only reads the rows of the cells that overlap the
+    bounding box of the route, and the distance is computed for those rows.
+
+    Args:
+        index (dict): The index returned by build_spatial_index.
+        points (list): The (longitude, latitude) of the points of the route. A single point
+            gives the accidents within a radius.
+        km (float): The distance, in kilometers.
+
+    Returns:
+        numpy.ndarray: The sorted positions of the rows within the distance of the route.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 1:
+        points = np.vstack([points, points])
+    found = []
+    for a, b in zip(points[:-1], points[1:]):
+        # Se toman puntos del arco cada step km como máximo, de modo que todo accidente a menos
+        # de km del arco está a menos de km + step / 2 de alguno de ellos, y se busca en la caja que
+        # contiene los círculos de ese radio alrededor de cada punto
+        step = max(km, 1.0)
+        va, vb = _unit_vectors(*a), _unit_vectors(*b)
+        angle = float(_angle(va, vb))
+        if angle > 1e-12:
+            t = np.linspace(0, 1, int(np.ceil(angle * EARTH_RADIUS_KM / step)) + 1)[:, None]
+            arc = (np.sin((1 - t) * angle) * va + np.sin(t * angle) * vb) / np.sin(angle)
+            arc_lon = np.degrees(np.arctan2(arc[:, 1], arc[:, 0]))
+            arc_lat = np.degrees(np.arcsin(np.clip(arc[:, 2], -1, 1)))
+            margin = step / 2
+        else:
+            arc_lon, arc_lat, margin = np.array([a[0]]), np.array([a[1]]), 0.0
+        min_lon, min_lat, max_lon, max_lat = _cap_bbox(arc_lon, arc_lat, km + margin)
+
+        # La caja se divide en dos si cruza el antimeridiano
+        boxes = [(max(min_lon, -180.0), min(max_lon, 180.0))]
+        if min_lon < -180:
+            boxes.append((min_lon + 360, 180.0))
+        if max_lon > 180:
+            boxes.append((-180.0, max_lon - 360))
+        pos = np.unique(np.concatenate([_bbox_candidates(index, low, min_lat, high, max_lat) for low, high in boxes]))
+
+        dist = _arc_distance(index['longitude'][pos], index['latitude'][pos], a, b)
+        found.append(index['rows'][pos[dist <= km]])
+    return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int32)
+
+@st.cache_resource
+def load_spatial_index(file_path, _data, cell_size=0.1, version=None):
+    """
+    Builds the spatial index of the data loaded from a dataset, once per Streamlit server.
+
+    Args:
+        file_path (str): The path to the dataset directory, used as the cache key.
+        _data (pandas.DataFrame): The data loaded from file_path with load_data_arrow. It is not hashed.
+        cell_size (float, optional): The side of the grid cells, in degrees. Default is 0.1.
+        version (str, optional): The version of the dataset (see dataset_version), used as the cache key.
+
+    Returns:
+        dict: The index returned by build_spatial_index.
+    """
+    return build_spatial_index(_data, cell_size)
+
+@traced()
+def aggregate_cube(data, categories, measures):
+    """
+    Counts the accidents and adds up the measures per State, Year and category, for each category.
+
+    Args:
+        data (pandas.DataFrame): The accident data.
+        categories (list): The categories to aggregate by, e.g. ['Month', 'Hour'].
+        measures (list): The numeric columns to add up.
+
+    Returns:
+        dict: For each category, a pandas DataFrame with the columns State, Year, the category,
+            'Total accidents' and the measures. Only the combinations present in the data are included.
+    """
+    return {cat: _aggregate(data, ['State', 'Year', cat], measures) for cat in categories}
+
+def _aggregate(data, keys, measures):
+    """
+    Counts the accidents and adds up the measures per combination of the keys present in the data.
+    """
+    grouped = data.groupby(list(dict.fromkeys(keys)), observed=True)
+    table = grouped[measures].sum()
+    table.insert(0, 'Total accidents', grouped.size())
+    return table.reset_index()
+
+def aggregate_rollup(data, measures):
+    """
+    Counts the accidents and adds up the measures per State and calendar period, for each level of ROLLUP_LEVELS.
+
+    The 'Day' level holds every date, from which the weeks, months, quarters and years are rolled up
+    (see read_rollup), and the 'Hour' level holds the hours of each day of the week. Both are cubes,
+    so they are merged and written with merge_cubes and write_cube.
+
+    Args:
+        data (pandas.DataFrame): The accident data.
+        measures (list): The numeric columns to add up.
+
+    Returns:
+        dict: For each level, a pandas DataFrame with the columns State, Year, the keys of the level,
+            'Total accidents' and the measures.
+    """
+    return {level: _aggregate(data, ['State', 'Year'] + keys, measures) for level, keys in ROLLUP_LEVELS.items()}
+
+def merge_cubes(cubes):
+    """
+    Adds up cubes computed by aggregate_cube or aggregate_rollup over disjoint parts of the data.
+
+    The keys of each table are its columns before 'Total accidents'.
+
+    Args:
+        cubes (list): The cubes to add up, all with the same categories.
+
+    Returns:
+        dict: The merged cube.
+    """
+    cube = {}
+    for cat in cubes[0]:
+        table = pd.concat([item[cat] for item in cubes], ignore_index=True)
+        keys = list(table.columns[:table.columns.get_loc('Total accidents')])
+        cube[cat] = table.groupby(keys, observed=True, sort=False).sum().reset_index()
+    return cube
+
+def write_cube(cube, path):
+    """
+    Writes a cube as one dataset per category, partitioned by Year.
+
+    Args:
+        cube (dict): The cube returned by aggregate_cube or merge_cubes.
+        path (str): The path to the cube directory.
+
+    Returns:
+        None
+    """
+    for cat, table in cube.items():
+        write_dataset(table, os.path.join(path, cat), partition_cols=('Year',))
+
+@traced()
+def build_top_lists(table, category, measures, k=TOP_LIST_SIZE):
+    """
+    Ranks the values of a category with the largest sums of each measure, keeping the top k.
+
+    The lists are computed for each State and Year, for each State over all the years, for each
+    Year over all the states, and for all the data, which are the selections of the dashboard.
+    Other selections are answered by merging the lists of their State and Year (see queries.py).
+    The 'Not Applicable' cities are left out, as in the dashboard.
+
+    Args:
+        table (pandas.DataFrame): The cube table of the category (see aggregate_cube).
+        category (str): The category to rank, e.g. 'City'.
+        measures (list): The measures to rank by, e.g. ['Total accidents', 'Fatals'].
+        k (int, optional): The length of each list. Default is TOP_LIST_SIZE.
+
+    Returns:
+        pandas.DataFrame: The columns State ('' for all the states), Year (0 for all the years),
+            Measure, the category and Value, sorted by Value in descending order within each list.
+    """
+    if category == 'City':
+        table = table[table[category] != "Not Applicable"]
+    lists = []
+    for scope in (['State', 'Year'], ['State'], ['Year'], []):
+        sums = table.groupby(scope + [category], observed=True)[measures].sum().reset_index()
+        for measure in measures:
+            ranked = sums.sort_values(measure, ascending=False, kind='stable')
+            ranked = ranked.groupby(scope, observed=True).head(k) if scope else ranked.head(k)
+            lists.append(pd.DataFrame({'State': ranked['State'].astype(str) if 'State' in scope else '',
+                                       'Year': ranked['Year'].astype('int32') if 'Year' in scope else 0,
+                                       'Measure': measure,
+                                       category: ranked[category],
+                                       'Value': ranked[measure].astype('int64')}))
+    lists = pd.concat(lists, ignore_index=True)
+    lists['State'] = lists['State'].astype('category')
+    lists['Measure'] = lists['Measure'].astype('category')
+    return lists
+
+def write_top_lists(lists, path):
+    """
+    Writes the top lists of each category (see build_top_lists) in the '_top' directory of a cube,
+    replacing the previous ones.
+
+    Args:
+        lists (dict): The top lists of each category.
+        path (str): The path to the cube directory.
+
+    Returns:
+        None
+    """
+    top_path = os.path.join(path, '_top')
+    shutil.rmtree(top_path, ignore_errors=True)
+    for cat, table in lists.items():
+        write_dataset(table, os.path.join(top_path, cat), partition_cols=('Year',))
+
+def index_top_lists(lists):
+    """
+    Indexes the top lists of a category (see build_top_lists) by Measure, State and Year.
+
+    Args:
+        lists (pandas.DataFrame): The top lists of the category.
+
+    Returns:
+        dict: The lists under 'lists', the positions of the rows of each (Measure, State, Year)
+            under 'cells', and the states and years of the lists under 'states' and 'years'.
+    """
+    cells = lists.groupby(['Measure', 'State', 'Year'], observed=True, sort=False).indices
+    return {'lists': lists,
+            'cells': {(measure, state, int(year)): rows for (measure, state, year), rows in cells.items()},
+            'states': {state for _, state, _ in cells} - {''},
+            'years': {int(year) for _, _, year in cells} - {0}}
+
+@traced()
+def read_cube(path, categories):
+    """
+    Reads a cube written by write_cube.
+
+    The top lists of the categories that have them (see write_top_lists) are read too,
+    indexed by index_top_lists, under the key '_top', and the rollup store of the cube
+    (see read_rollup), if it was written, under the key '_rollup'.
+
+    Args:
+        path (str): The path to the cube directory.
+        categories (list): The categories to read.
+
+    Returns:
+        dict: The table of each category, as a pandas DataFrame, the dict of top lists under '_top'
+            and the dict of rollup tables under '_rollup'.
+    """
+    cube = {cat: read_dataset(os.path.join(path, cat)) for cat in categories}
+    cube['_top'] = {cat: index_top_lists(read_dataset(os.path.join(path, '_top', cat))) for cat in categories
+                    if os.path.isdir(os.path.join(path, '_top', cat))}
+    cube['_rollup'] = read_rollup(os.path.join(path, '_rollup'))
+    return cube
+
+def read_rollup(path):
+    """
+    Reads the rollup store of a cube, written with write_cube from aggregate_rollup.
+
+    The dates of the 'Day' level are added as the column Date, which is missing (NaT) for the
+    accidents whose day is unknown or not a valid date, and the first day of their month as
+    the column 'Month start', so that the periods of any calendar level can be computed from them.
+
+    Args:
+        path (str): The path to the rollup directory.
+
+    Returns:
+        dict: The table of each level, as a pandas DataFrame. Empty if the store was not written.
+    """
+    rollup = {level: read_dataset(os.path.join(path, level)) for level in ROLLUP_LEVELS
+              if os.path.isdir(os.path.join(path, level))}
+    if 'Day' in rollup:
+        day = rollup['Day']
+        month = day['Month'].astype(str).map(MONTH_NUMBERS)
+        day['Date'] = pd.to_datetime(pd.DataFrame({'year': day['Year'], 'month': month, 'day': day['Day of month']}),
+                                     errors='coerce')
+        day['Month start'] = pd.to_datetime(pd.DataFrame({'year': day['Year'], 'month': month, 'day': 1}),
+                                            errors='coerce')
+    return rollup
+
+@st.cache_resource
+def load_cube_arrow(file_path, categories, version=None):
+    """
+    Loads a cube written by write_cube.
+
+    The returned tables are shared by every session of the Streamlit server,
+    so they must be treated as read-only.
+
+    Args:
+        file_path (str): The path to the cube directory.
+        categories (list): The categories to read.
+        version (str, optional): The version of the dataset the cube was built from (see dataset_version).
+            It is only used as part of the cache key, so that a new version is loaded again.
+
+    Returns:
+        dict: The table of each category, as a pandas DataFrame.
+    """
+    return read_cube(file_path, categories)
+
+@traced()
+def build_state_totals(table, measures, codes):
+    """
+    Arranges the totals per State and Year of a cube as a dense array.
+
+    Any selection of years is then answered by adding the vectors of those years,
+    without grouping the cube again.
+
+    Args:
+        table (pandas.DataFrame): The 'State' table of a cube (see aggregate_cube).
+        measures (list): The measures to include, e.g. ['Total accidents', 'Fatals'].
+        codes (dict): The postal code of each state name, e.g. rename.code_state.
+
+    Returns:
+        dict: The states, their postal codes, the years, the measures and the totals,
+            as an array of shape (states, years, measures).
+    """
+    state_idx, states = pd.factorize(table['State'].astype(str), sort=True)
+    year_idx, years = pd.factorize(table['Year'], sort=True)
+    values = np.zeros((len(states), len(years), len(measures)), dtype=np.int64)
+    np.add.at(values, (state_idx, year_idx), table[measures].to_numpy(dtype=np.int64))
+    return {'states': list(states),
+            'codes': [codes.get(state) for state in states],
+            'years': [int(year) for year in years],
+            'measures': list(measures),
+            'values': values}
+
+def sum_state_totals(totals, years, measure):
+    """
+    Adds up the totals of each state over a selection of years.
+
+    Args:
+        totals (dict): The totals returned by build_state_totals.
+        years (list): The years to add up, as integers.
+        measure (str): The measure to add up.
+
+    Returns:
+        pandas.DataFrame: The columns State, code_state and the measure, with one row per state.
+    """
+    year_pos = [i for i, year in enumerate(totals['years']) if year in set(years)]
+    values = totals['values'][:, year_pos, totals['measures'].index(measure)].sum(axis=1)
+    return pd.DataFrame({'State': totals['states'], 'code_state': totals['codes'], measure: values})
+
+@st.cache_resource
+def load_state_totals(file_path, _cube, measures, codes, version=None):
+    """
+    Builds the totals per State and Year of a cube, once per Streamlit server.
+
+    Args:
+        file_path (str): The path to the cube directory, used as the cache key.
+        _cube (dict): The cube loaded from file_path with load_cube_arrow. It is not hashed.
+        measures (list): The measures to include.
+        codes (dict): The postal code of each state name, e.g. rename.code_state.
+        version (str, optional): The version of the dataset the cube was built from (see dataset_version).
+
+    Returns:
+        dict: The totals returned by build_state_totals.
+    """
+    return build_state_totals(_cube['State'], measures, codes)
+
 def read_data(item, path):
     """
     Reads a CSV file from the specified path and returns the data as a pandas DataFrame.
 
+    The encoding of the file is found with detect_encoding.
+
     Args:
         item (str): The name of the CSV file to read.
         path (str): The path to the directory containing the CSV file.
@@ -32,78 +1043,604 @@ def read_data(item, path):
 
     Raises:
         FileNotFoundError: If the specified CSV file is not found in the given path.
-        UnicodeDecodeError: If an encoding other than "ISO-8859-1" is used and the CSV file cannot be decoded.
     """
-    try:
-        data = pd.read_csv(os.path.join(path, item, low_memory=False))
-    except:
-        data = pd.read_csv(os.path.join(path, item), encoding = "ISO-8859-1", low_memory=False)    
-    return data
+    file_path = os.path.join(path, item)
+    return pd.read_csv(file_path, encoding=detect_encoding(file_path), low_memory=False)
+
+def detect_encoding(file_path, encodings=('utf-8', 'cp1252'), block_size=2**20):
+    """
+    Finds the first encoding that decodes a whole file.
+
+    The FARS files are written as Windows-1252, whose characters such as the en dash of
+    'Dark – Lighted' are decoded as control characters by ISO-8859-1. The file is decoded one
+    block at a time, without keeping the text, before reading it.
+
+    Args:
+        file_path (str): The path of the file.
+        encodings (tuple, optional): The encodings to try, in order. Default is UTF-8 and Windows-1252.
+        block_size (int, optional): The number of bytes decoded at a time. Default is 1 MB.
+
+    Returns:
+        str: The first encoding that decodes the file, or "ISO-8859-1", which decodes any byte.
+    """
+    for encoding in encodings:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            with open(file_path, 'rb') as file:
+                for block in iter(lambda: file.read(block_size), b''):
+                    decoder.decode(block)
+            decoder.decode(b'', final=True)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "ISO-8859-1"
+
+def list_year_files(path, pattern=r'accident_(\d{4})\.csv'):
+    """
+    Finds the yearly accident files in a directory by matching their names against a pattern.
+
+    Args:
+        path (str): The path to the directory containing the CSV files.
+        pattern (str, optional): Regular expression matched case-insensitively against each file name.
+            Its first group must capture the year. Default matches accident_20xx.csv.
+
+    Returns:
+        dict: The file names keyed by year (int), in ascending year order.
+    """
+    regex = re.compile(pattern, re.IGNORECASE)
+    files = {}
+    for item in os.listdir(path):
+        match = regex.fullmatch(item)
+        if match:
+            files[int(match.group(1))] = item
+    return dict(sorted(files.items()))
+
+def read_chunks(item, path, columns, dtype=None, chunksize=100000, encoding=None):
+    """
+    Reads a CSV file in chunks, parsing only the given columns.
+
+    Args:
+        item (str): The name of the CSV file to read.
+        path (str): The path to the directory containing the CSV file.
+        columns (iterable): The columns to parse. Columns missing from the file are ignored.
+        dtype (dict, optional): The data type of each column.
+        chunksize (int, optional): The number of rows of each chunk. Default is 100000.
+        encoding (str, optional): The encoding of the file. If not provided, it is found with detect_encoding.
+
+    Returns:
+        Iterator[pandas.DataFrame]: The chunks of the file.
+    """
+    columns = set(columns)
+    file_path = os.path.join(path, item)
+    return pd.read_csv(file_path, 
+                       usecols=lambda col: col in columns, 
+                       dtype=dtype, 
+                       chunksize=chunksize, 
+                       encoding=encoding or detect_encoding(file_path))
+
+def map_years(func, files, workers=None, **kwargs):
+    """
+    Processes the yearly accident files concurrently on a process pool.
+
+    Args:
+        func (callable): A module-level function called as func(year, item, **kwargs) for each file.
+        files (dict): The file names keyed by year, as returned by list_year_files.
+        workers (int, optional): The number of worker processes. If not provided, one per CPU is used.
+        **kwargs: Additional keyword arguments passed to func.
+
+    Returns:
+        dict: The value returned by func for each file, keyed by year (int).
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {year: executor.submit(func, year, item, **kwargs) for year, item in files.items()}
+        return {year: future.result() for year, future in futures.items()}
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """
+    Computes the SHA-256 hash of a file's content, reading it in chunks.
+
+    Args:
+        file_path (str): The path to the file.
+        chunk_size (int, optional): The number of bytes read at a time. Default is 1 MiB.
+
+    Returns:
+        str: The hexadecimal digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def dataset_metadata(cube):
+    """
+    Summarizes the states and years of the dataset from the 'State' table of its cube.
+
+    Args:
+        cube (dict): The cube of the dataset, with at least its 'State' table (see aggregate_cube).
+
+    Returns:
+        dict: The sorted states and years, and the number of accidents of each year.
+    """
+    table = cube['State']
+    rows = table.groupby('Year')['Total accidents'].sum()
+    return {'states': sorted(table['State'].astype(str).unique()),
+            'years': [int(year) for year in rows.index],
+            'rows': {str(year): int(count) for year, count in rows.items()}}
+
+@st.cache_data
+def load_metadata(file_path, cube_path, version=None):
+    """
+    Loads the states and years of a dataset, as written in its manifest by the ETL.
+
+    If the manifest does not include them, they are computed from the 'State' table of the cube.
+
+    Args:
+        file_path (str): The path to the JSON manifest.
+        cube_path (str): The path to the cube directory.
+        version (str, optional): The version of the dataset (see dataset_version), used as the cache key.
+
+    Returns:
+        dict: The metadata returned by dataset_metadata.
+    """
+    metadata = read_manifest(file_path).get('metadata')
+    if metadata is None:
+        metadata = dataset_metadata(read_cube(cube_path, ['State']))
+    return metadata
+
+def read_manifest(file_path):
+    """
+    Reads the manifest of the source files processed by the ETL.
+
+    Args:
+        file_path (str): The path to the JSON manifest.
+
+    Returns:
+        dict: The manifest, or an empty dict if the file does not exist.
+    """
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, encoding='utf-8') as file:
+        return json.load(file)
+
+def write_manifest(file_path, manifest):
+    """
+    Writes the manifest of the source files processed by the ETL.
+
+    The file is replaced atomically, so an interrupted run never leaves a partial manifest.
+
+    Args:
+        file_path (str): The path to the JSON manifest.
+        manifest (dict): The manifest to write.
+
+    Returns:
+        None
+    """
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, file_path)
+
+def source_entry(file_path, previous=None):
+    """
+    Describes a source file for the ETL manifest.
+
+    The content hash is only recomputed when the size or modification time of the file
+    differ from the previous entry.
+
+    Args:
+        file_path (str): The path to the file.
+        previous (dict, optional): The entry of the same file in the previous manifest.
+
+    Returns:
+        dict: The file name, size, modification time and SHA-256 hash of the file.
+    """
+    stat = os.stat(file_path)
+    entry = {'file': os.path.basename(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and all(previous.get(key) == entry[key] for key in ('file', 'size', 'mtime_ns')):
+        entry['sha256'] = previous['sha256']
+    else:
+        entry['sha256'] = file_hash(file_path)
+    return entry
+
+def map_codes(data, mappings):
+    """
+    Maps code columns of a DataFrame to their labels, storing the results as categorical columns.
+
+    Each column is factorized in a single pass and only its distinct codes are looked up in
+    the dictionary, so the cost does not grow with the size of the dictionary. The DataFrame
+    is modified in place, without copying the remaining columns.
+
+    Args:
+        data (pd.DataFrame): The input DataFrame.
+        mappings (dict): The target column and the code-to-label dictionary of each source column,
+            e.g. {'STATE': ('STATENAME', state_name)}. Source columns missing from the DataFrame are ignored.
+
+    Returns:
+        dict: The codes without a label in each source column, with their number of rows.
+            Those codes are kept as text labels.
+    """
+    missing = {}
+    for col, (target, mapping) in mappings.items():
+        if col not in data.columns:
+            continue
+        codes, uniques = pd.factorize(data[col])
+        uniques = pd.Series(np.asarray(uniques, dtype=object))
+        labels = uniques.map(mapping)
+        unmapped = labels.isna().to_numpy()
+        if unmapped.any():
+            counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+            missing[col] = dict(zip(uniques[unmapped].tolist(), counts[unmapped].tolist()))
+            labels[unmapped] = uniques[unmapped].astype(str)
+        label_codes, categories = pd.factorize(labels.to_numpy(dtype=object))
+        data[target] = pd.Categorical.from_codes(np.where(codes >= 0, label_codes[codes], -1), categories)
+    return missing
+
+def map_keys(data, keys, lookup, target, special=None):
+    """
+    Maps composite code keys of a DataFrame to their labels, storing the result as a categorical column.
 
-def data_replace(data, list_cols):
+    The keys of every row are looked up at once in the index of the lookup table, which is
+    equivalent to a left merge that keeps the row order. The DataFrame is modified in place,
+    without copying the remaining columns.
+
+    Args:
+        data (pd.DataFrame): The input DataFrame.
+        keys (list): The key columns, e.g. ['STATE', 'COUNTY'].
+        lookup (pd.DataFrame): The key columns and a 'NAME' column, with one row per key.
+        target (str): The column where the labels are stored.
+        special (dict, optional): The labels of codes of the last key column that have the same
+            meaning in every state, e.g. {9999: 'Unknown'}. They are used for the keys not found in the lookup.
+
+    Returns:
+        dict: The keys, as tuples, not found in the lookup nor in the special codes, with their number of rows.
+            Their last code is kept as a text label.
+    """
+    names = lookup['NAME'].astype('category')
+    name_codes, categories = names.cat.codes.to_numpy(), names.cat.categories
+    positions = pd.MultiIndex.from_frame(lookup[keys]).get_indexer(pd.MultiIndex.from_frame(data[keys]))
+    codes = np.where(positions >= 0, name_codes[positions], -1)
+    missing = {}
+    unmatched = positions < 0
+    if unmatched.any():
+        extra = data.loc[unmatched, keys]
+        labels = extra[keys[-1]].map(special or {})
+        not_special = labels.isna()
+        if not_special.any():
+            counts = extra[not_special].value_counts()
+            missing = {tuple(int(item) for item in key): int(count) for key, count in counts.items()}
+            labels[not_special] = extra.loc[not_special, keys[-1]].astype(str)
+        categories = categories.append(pd.Index(labels.unique()).difference(categories))
+        codes[unmatched] = categories.get_indexer(labels)
+    data[target] = pd.Categorical.from_codes(codes, categories).remove_unused_categories()
+    return missing
+
+@traced()
+def load_glc(file_path, cache_path):
+    """
+    Loads the county and city lookup tables of the geographic locator codes (GLC) workbook.
+
+    The workbook is parsed only when its content changed since the previous call; otherwise
+    the lookups are read from the Feather files stored in the cache directory.
+
+    Args:
+        file_path (str): The path to the GLC xlsx file.
+        cache_path (str): The path to the directory where the parsed lookups are stored.
+
+    Returns:
+        tuple: The county lookup, keyed by (STATE, COUNTY), and the city lookup, keyed by
+            (STATE, COUNTY, CITY), as pandas DataFrames with a 'NAME' column.
+    """
+    source_path = os.path.join(cache_path, '_source.json')
+    county_path = os.path.join(cache_path, 'county.feather')
+    city_path = os.path.join(cache_path, 'city.feather')
+    previous = read_manifest(source_path)
+    entry = source_entry(file_path, previous)
+    if previous.get('sha256') == entry['sha256'] and os.path.exists(county_path) and os.path.exists(city_path):
+        return pd.read_feather(county_path), pd.read_feather(city_path)
+
+    glc = pd.read_excel(file_path, usecols=['State Code', 'County Code', 'County Name', 'City Code', 'City Name'])
+    glc = glc.rename(columns={'State Code': 'STATE', 'County Code': 'COUNTY', 'City Code': 'CITY'})
+    glc[['STATE', 'COUNTY', 'CITY']] = glc[['STATE', 'COUNTY', 'CITY']].astype('int16')
+    county = glc.drop_duplicates(['STATE', 'COUNTY']).loc[:, ['STATE', 'COUNTY', 'County Name']]
+    county = county.rename(columns={'County Name': 'NAME'}).reset_index(drop=True)
+    city = glc.drop_duplicates(['STATE', 'COUNTY', 'CITY']).loc[:, ['STATE', 'COUNTY', 'CITY', 'City Name']]
+    city = city.rename(columns={'City Name': 'NAME'}).reset_index(drop=True)
+    for lookup in (county, city):
+        lookup['NAME'] = lookup['NAME'].str.lower().str.title().astype('category')
+
+    os.makedirs(cache_path, exist_ok=True)
+    county.to_feather(county_path)
+    city.to_feather(city_path)
+    write_manifest(source_path, entry)
+    return county, city
+
+def enforce_schema(data, schema, ordinal=None):
     """
-    Replaces specified columns in a DataFrame with new values.
+    Casts the columns of a DataFrame to the data types declared in a schema.
+
+    Label columns are stored as categoricals and numeric columns with the declared width.
+    Integer columns with missing values use the pandas nullable type of the same width.
+    Ordinal columns are stored as ordered categoricals with the declared categories, so that
+    every part of the dataset shares the same categories and sorting them follows their order.
 
     Args:
         data (pd.DataFrame): The input DataFrame.
-        list_cols (list): A list of dictionaries specifying the columns to replace and their corresponding new values.
+        schema (dict): The data type of each column, e.g. {'State': 'category', 'Fatals': 'int16'}.
+            Columns missing from the DataFrame are ignored.
+        ordinal (dict, optional): The ordered categories of the ordinal columns, e.g. {'Month': ['January', ...]}.
+
+    Returns:
+        pd.DataFrame: The DataFrame with the declared data types.
+
+    Raises:
+        ValueError: If a column holds values outside the range of its declared integer type,
+            or outside the categories of an ordinal column.
+    """
+    ordinal = ordinal or {}
+    dtypes = {}
+    for col, dtype in schema.items():
+        if col not in data.columns:
+            continue
+        if col in ordinal:
+            values = data[col].dropna()
+            unknown = set(values.unique()) - set(ordinal[col])
+            if unknown:
+                raise ValueError(f"Column '{col}' has values outside its ordered categories: {sorted(map(str, unknown))}")
+            dtype = pd.CategoricalDtype(ordinal[col], ordered=True)
+        elif dtype != 'category' and np.issubdtype(np.dtype(dtype), np.integer):
+            info = np.iinfo(dtype)
+            values = data[col]
+            if values.min() < info.min or values.max() > info.max:
+                raise ValueError(f"Column '{col}' has values outside the range of {dtype}: "
+                                 f"[{values.min()}, {values.max()}]")
+            if values.isna().any():
+                dtype = dtype.capitalize()
+        dtypes[col] = dtype
+    return data.astype(dtypes)
+
+def memory_report(data_before, data_after):
+    """
+    Compares the memory used by each column of a DataFrame before and after a transformation.
+
+    Args:
+        data_before (pd.DataFrame): The DataFrame before the transformation.
+        data_after (pd.DataFrame): The DataFrame after the transformation.
+
+    Returns:
+        pd.DataFrame: The bytes used by each column before and after, and their ratio, with a 'Total' row.
+    """
+    report = pd.DataFrame({'before': data_before.memory_usage(deep=True, index=False),
+                           'after': data_after.memory_usage(deep=True, index=False)})
+    report.loc['Total'] = report.sum()
+    report['ratio'] = (report['before'] / report['after']).round(1)
+    return report
+
+def quality_columns(sentinels, ranges, bounds, domains):
+    """
+    Returns the columns checked by validate_data, in the order of their bits in the 'Quality' column.
+
+    Args:
+        sentinels (dict): The sentinel codes of each column.
+        ranges (dict): The valid range of each column.
+        bounds (dict): The bounds of each coordinate column.
+        domains (dict): The valid values of each categorical column.
+
+    Returns:
+        list: 'Date' followed by the columns of the rules.
+    """
+    return list(dict.fromkeys(['Date'] + list(sentinels) + list(ranges) + list(bounds) + list(domains)))
+
+@traced()
+def validate_data(data, sentinels, ranges, bounds, domains):
+    """
+    Checks the sentinel codes, value ranges, dates, coordinates and categories of the accident data.
+
+    Each rule is checked on a whole column at once. The rows that break a rule are flagged in the
+    new int32 column 'Quality', whose bit i is set when the i-th column of quality_columns is not
+    valid. The coordinates that are sentinel codes or outside their bounds are set to missing
+    (NaN) in both coordinate columns, so they do not move the maps. The other values are kept,
+    e.g. the unknown hour 99 still counts as its own category.
+
+    Args:
+        data (pandas.DataFrame): The accident data, with the data types of enforce_schema. It is modified in place.
+        sentinels (dict): The sentinel codes of each column, e.g. {'Hour': [99]}.
+        ranges (dict): The (minimum, maximum) of each numeric column. None means no limit.
+        bounds (dict): The (minimum, maximum) of each coordinate column, e.g. {'latitude': (18.0, 72.0)}.
+        domains (dict): The valid values of each categorical column, e.g. {'Month': ['January', ...]}.
+
+    Returns:
+        tuple: The data with the 'Quality' column and the number of rows that break each rule,
+            keyed as 'column: rule' ('sentinel', 'range', 'bounds', 'domain' or 'invalid').
+    """
+    columns = quality_columns(sentinels, ranges, bounds, domains)
+    flags = np.zeros(len(data), dtype=np.int32)
+    counts = {}
+
+    def flag(column, rule, mask):
+        count = int(np.count_nonzero(mask))
+        if count:
+            counts[f'{column}: {rule}'] = counts.get(f'{column}: {rule}', 0) + count
+            np.bitwise_or(flags, np.int32(1 << columns.index(column)), out=flags, where=mask)
+
+    values = {col: data[col].to_numpy(dtype=np.float64, na_value=np.nan)
+              for col in dict.fromkeys(list(sentinels) + list(ranges) + list(bounds)) if col in data.columns}
+    # Las columnas sin códigos de valor desconocido no tienen ninguna fila marcada como tal
+    none = np.zeros(len(data), dtype=bool)
+    is_sentinel = {}
+    for col, codes in sentinels.items():
+        if col in values:
+            # Los códigos se comparan con una tolerancia, ya que las coordenadas se guardan en float32
+            is_sentinel[col] = none.copy()
+            for code in codes:
+                is_sentinel[col] |= np.abs(values[col] - code) < 1e-3
+            flag(col, 'sentinel', is_sentinel[col])
+
+    for col, (low, high) in ranges.items():
+        if col in values:
+            outside = np.zeros(len(data), dtype=bool)
+            if low is not None:
+                outside |= values[col] < low
+            if high is not None:
+                outside |= values[col] > high
+            flag(col, 'range', outside & ~is_sentinel.get(col, none))
+
+    # Se verifica que el día exista en el calendario, p. ej. que no sea el 30 de febrero
+    if {'Year', 'Month', 'Day of month'} <= set(data.columns):
+        months = data['Month'].cat.categories.map(MONTH_NUMBERS).to_numpy(dtype=np.float64, na_value=np.nan)
+        codes = data['Month'].cat.codes.to_numpy()
+        month = np.where(codes >= 0, np.append(months, np.nan)[codes], np.nan)
+        year = data['Year'].to_numpy(dtype=np.float64, na_value=np.nan)
+        day = data['Day of month'].to_numpy(dtype=np.float64, na_value=np.nan)
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        length = np.array([np.nan, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.nan_to_num(month).astype(int)]
+        length = length + ((month == 2) & leap)
+        invalid = ~((day >= 1) & (day <= length))
+        flag('Date', 'invalid', invalid & ~is_sentinel.get('Day of month', none))
+
+    wrong = np.zeros(len(data), dtype=bool)
+    for col, (low, high) in bounds.items():
+        if col in values:
+            outside = (values[col] < low) | (values[col] > high)
+            flag(col, 'bounds', outside & ~is_sentinel.get(col, none))
+            wrong |= outside
+    if wrong.any():
+        for col in bounds:
+            if col in data.columns:
+                data[col] = data[col].mask(wrong)
+
+    # Los valores de las categorías se verifican una sola vez, y cada fila a través de su código
+    for col, domain in domains.items():
+        if col in data.columns:
+            invalid = np.append(~data[col].cat.categories.isin(domain), False)
+            flag(col, 'domain', invalid[data[col].cat.codes.to_numpy()])
+
+    data['Quality'] = flags
+    return data, counts
+
+def bin_size(zoom, latitude, pixels=4):
+    """
+    Computes the size, in meters, of the bins that cover a number of pixels on a web map.
+
+    Args:
+        zoom (float): The zoom level of the map.
+        latitude (float): The latitude at the center of the map.
+        pixels (int, optional): The number of pixels covered by a bin. Default is 4.
+
+    Returns:
+        float: The distance, in meters, from the center to a vertex of the bins.
+    """
+    return pixels * 156543.03 * np.cos(np.radians(latitude)) / 2 ** zoom
+
+@traced()
+def hex_bin(longitude, latitude, values, size):
+    """
+    Groups points into a grid of hexagons and aggregates a variable in each one.
+
+    The points are projected to meters around their mean latitude and each one is assigned
+    to the nearest hexagon center, with vectorized operations over all the points.
+
+    Args:
+        longitude (array-like): The longitude of the points.
+        latitude (array-like): The latitude of the points.
+        values (array-like): The variable to sum in each hexagon.
+        size (float): The distance, in meters, from the center to a vertex of the hexagons.
 
     Returns:
-        pd.DataFrame: The DataFrame with replaced values.
-    """        
-    data = data.replace({"STATE": list_cols[0]})
-    data = data.replace({"DAY_WEEK": list_cols[1]})
-    data = data.replace({"MONTH": list_cols[2]})
-    data = data.replace({"WEATHER": list_cols[3]})
-    data = data.replace({"ROUTE": list_cols[4]})
-    data = data.replace({"LGT_COND": list_cols[5]})
+        pandas.DataFrame: The longitude and latitude of the center of each non-empty hexagon,
+            with its number of points ('count') and the sum of the values ('value').
+    """
+    longitude = np.asarray(longitude, dtype=np.float64)
+    latitude = np.asarray(latitude, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(longitude) & np.isfinite(latitude)
+    longitude, latitude, values = longitude[valid], latitude[valid], np.nan_to_num(values[valid])
+    if len(longitude) == 0:
+        return pd.DataFrame({'longitude': [], 'latitude': [], 'count': [], 'value': []})
     
-    data = data.rename(columns={'STATE':'STATENAME'})
-    data = data.rename(columns={'DAY_WEEK':'DAY_WEEKNAME'})
-    data = data.rename(columns={'MONTH':'MONTHNAME'})
-    data = data.rename(columns={'WEATHER':'WEATHERNAME'})
-    data = data.rename(columns={'ROUTE':'ROUTENAME'})
-    data = data.rename(columns={'LGT_COND':'LGT_CONDNAME'})
+    # Proyección equirectangular local, en metros
+    scale_x = 111320 * np.cos(np.radians(latitude.mean()))
+    x = longitude * scale_x / size
+    y = latitude * 110540 / size
     
-    return data
+    # Coordenadas axiales de los hexágonos (vértice arriba) y redondeo al hexágono más cercano
+    q = np.sqrt(3) / 3 * x - y / 3
+    r = 2 / 3 * y
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    
+    cells = np.stack([rq, rr], axis=1).astype(np.int64)
+    cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    count = np.bincount(inverse)
+    value = np.bincount(inverse, weights=values)
+    
+    center_x = np.sqrt(3) * (cells[:, 0] + cells[:, 1] / 2)
+    center_y = 1.5 * cells[:, 1]
+    return pd.DataFrame({'longitude': center_x * size / scale_x,
+                         'latitude': center_y * size / 110540,
+                         'count': count,
+                         'value': value})
 
-def replace_state_county_city(data_year, list_cols):
+@traced()
+def hist_counts(data: pd.DataFrame, bins: int=30) -> dict:
     """
-    Replaces state, county, and city values in the given DataFrame with the corresponding values from the provided list.
+    Computes the histogram and the mean of every column of a DataFrame, without drawing them.
+
+    The counts are computed by numpy.histogram on the values of each column, in their own 
+    data type, which is faster than converting the whole DataFrame to a single array.
+    The missing values are left out.
 
     Args:
-        data_year (DataFrame): The input DataFrame containing the data.
-        list_cols (list): A list of replacement values for state, county, and city in the following order:
-                          [state_values, county_values, city_values].
+        data (pd.DataFrame): The input DataFrame, with numeric columns.
+        bins (int, optional): The number of bins of each histogram. Default is 30.
 
     Returns:
-        DataFrame: A copy of the input DataFrame with the state, county, and city values replaced.
-    """    
-    data = data_year.copy(deep=True)
-    data['CODE_STATE'] = data['STATENAME']
-    data['CODE_STATE'] = data['CODE_STATE'].replace(list_cols[6])
-    data['COUNTY'] = data['COUNTY'].replace(list_cols[7])
-    data['CITY'] = data['CITY'].replace(list_cols[8])
-    return data
+        dict: For each column, a tuple with the counts of the bins, their edges and the mean of the column.
+    """
+    hists = {}
+    for col in data.columns:
+        values = data[col].dropna().to_numpy()
+        n, edges = np.histogram(values, bins=bins)
+        hists[col] = (n, edges, values.mean() if len(values) else np.nan)
+    return hists
 
 def graph_hist(data: pd.DataFrame, 
                bins: int=30,
                title_fig: str='', 
                label: bool=False, 
-               saveToFile: str='') -> None:
+               saveToFile: str='',
+               counts_only: bool=False):
     """
     Create a histogram for each column in a pandas DataFrame.
 
+    The counts of all the columns are computed first by hist_counts, and each histogram 
+    is drawn from those counts as a single filled step patch, instead of one patch per bin.
+
     Args:
         data (pd.DataFrame): The input DataFrame.
         bins (int, optional): The number of bins for the histogram. Default is 30.
         title_fig (str, optional): The title of the figure. Default is an empty string.
         label (bool, optional): Whether to label the histogram bars with density values. Default is False.
         saveToFile (str, optional): The filename to save the figure. If not provided, the figure will be displayed.
+        counts_only (bool, optional): Whether to return the counts without drawing the figure. Default is False.
 
     Returns:
-        None: This function does not return any value.
+        dict or None: The counts, edges and mean of each column if counts_only is True, otherwise None.
     """
+    hists = hist_counts(data, bins)
+    if counts_only:
+        return hists
+    
+    # matplotlib solo se importa al generar las figuras, ya que el dashboard no lo usa
+    import matplotlib.pyplot as plt
+    from matplotlib import gridspec
+
     name_cols = list(data.columns)
     n_cols = int(np.sqrt(len(name_cols)))
     n_rows = int(np.ceil(len(name_cols) / n_cols))
@@ -124,11 +1661,11 @@ def graph_hist(data: pd.DataFrame,
     
     for i, j in enumerate(data):
         ax = fig.add_subplot(gs[i])
-        n, bins_, _ = ax.hist(data.loc[:, j], bins=bins)
+        n, bins_, data_mean = hists[j]
+        ax.stairs(n, bins_, fill=True)
 
         if label == True:
             label_densityHist(ax, n, bins_, y=0.025, fontsize=16, fontweight='bold')
-        data_mean = data.loc[:, j].mean()
         ax.axvline(x=data_mean, label='mean', c="red", linestyle="--")
         min_ylim, max_ylim = ax.get_ylim()
         ax.text(data_mean, max_ylim*0.94, \
@@ -137,15 +1674,37 @@ def graph_hist(data: pd.DataFrame,
 
         ax.set_title(j, fontsize=20, fontweight='bold')
         ax.tick_params(axis="both", labelsize=18, rotation=0)
-        for i in range(1, len(ax.get_xticklabels())):
-            ax.get_xticklabels()[i].set_fontweight("bold")
-        for i in range(1, len(ax.get_yticklabels())):
-            ax.get_yticklabels()[i].set_fontweight("bold")
+        plt.setp(ax.get_xticklabels()[1:] + ax.get_yticklabels()[1:], fontweight="bold")
     if saveToFile == "":
         plt.show()
     else:
         fig.savefig(saveToFile, format='png', dpi=300)
+        plt.close(fig)
 
+def _render_hist(kwargs):
+    """
+    Draws a histogram figure to a file in a worker process, without a display.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    graph_hist(**kwargs)
+    return kwargs['saveToFile']
+
+def render_hists(jobs, workers=None):
+    """
+    Draws several histogram figures to files concurrently on a process pool.
+
+    Args:
+        jobs (list): The keyword arguments of graph_hist for each figure. Each one must include saveToFile.
+        workers (int, optional): The number of worker processes. If not provided, one per CPU is used.
+
+    Returns:
+        list: The files written, in the order of the jobs.
+    """
+    if any(not job.get('saveToFile') for job in jobs):
+        raise ValueError('Each figure must be saved to a file (saveToFile)')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_render_hist, jobs))
 
 def label_densityHist(ax, n, bins, x=4, y=0.01, r=2, freq='absolute', **kwargs):
     """
@@ -181,52 +1740,40 @@ def label_densityHist(ax, n, bins, x=4, y=0.01, r=2, freq='absolute', **kwargs):
     Reference:
     [1]https://matplotlib.org/3.1.1/api/text_api.html#matplotlib.text.Text
     """
-
-    k = []
-    # calculate the relative frequency of each bin
-    for i in range(0,len(n)):
-        k.append((bins[i+1]-bins[i])*n[i])
+    n = np.asarray(n)
+    bins = np.asarray(bins)
+    width = np.diff(bins)
     
-    # rounded
-    k = np.around(k,r); #print(k)
+    # calculate the position of each label, only for the non-empty bins
+    x_pos = width / x + bins[:-1]
+    y_pos = n + n * y
+    nonzero = np.flatnonzero(n != 0)
+    
+    if freq == 'absolute':
+        labels = n[nonzero].astype(int).astype(str)
+    elif freq == 'relative':
+        # relative frequency of each bin, rounded
+        labels = np.around(width * n, r)[nonzero].astype(str)
     
     # plot the label/text to each bin
-    for i in range(0, len(n)):
-        x_pos = (bins[i + 1] - bins[i]) / x + bins[i]
-        y_pos = n[i] + (n[i] * y)
-        if n[i] != 0:
-            if freq == 'absolute':
-                label = str(int(n[i])) # relative frequency of each bin
-            elif freq == 'relative':
-                label = str(k[i])
-            ax.text(x_pos, y_pos, label, kwargs)
+    for x_i, y_i, label in zip(x_pos[nonzero], y_pos[nonzero], labels):
+        ax.text(x_i, y_i, label, kwargs)
             
 def replace_name(data_sum, columns):
     """
-    Replaces the column names in the given DataFrame based on the specified column type.
+    Sorts the given DataFrame by an ordinal column, such as 'Month' or 'Day of week'.
+
+    The ordinal columns are stored as ordered categoricals (see enforce_schema), so the rows
+    are sorted by the codes of their categories. Other columns are left in their current order.
 
     Args:
         data_sum (pandas.DataFrame): The DataFrame containing the data.
-        columns (str): The type of column to be replaced. Possible values: 'Month', 'Day of week'.
-
-    Returns:
-        pandas.DataFrame: The modified DataFrame with the replaced column names.
-    """
-    if columns == 'Month':
-        data_sum['month'] = data_sum['Month']
-        month_name = { 'January': 1, 'February': 2, 'March': 3, 
-                       'April': 4, 'May': 5, 'June': 6, 'July': 7,
-                       'August': 8, 'September': 9, 'October': 10,
-                       'November': 11, 'December': 12}
-        data_sum = data_sum.replace({'month': month_name})
-        data_sum = data_sum.sort_values('month')
-        data_sum.drop('month', axis=1, inplace=True)
-
-    if columns == 'Day of week':    
-        data_sum['day_week'] = data_sum['Day of week']
-        dayweek_name = { 'Thursday': 5, 'Sunday': 1, 'Wednesday': 4,
-                         'Saturday': 7, 'Tuesday': 3, 'Monday': 2, 'Friday': 6}
-        data_sum = data_sum.replace({'day_week': dayweek_name})
-        data_sum = data_sum.sort_values('day_week')
-        data_sum.drop('day_week', axis=1, inplace=True)
+        columns (str): The column to sort by, if it is ordinal.
+
+    Returns:
+        pandas.DataFrame: The DataFrame sorted by the order of the column categories.
+    """
+    values = data_sum[columns]
+    if isinstance(values.dtype, pd.CategoricalDtype) and values.cat.ordered:
+        data_sum = data_sum.sort_values(columns, kind='stable')
     return data_sum            
\ No newline at end of file
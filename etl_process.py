@@ -1,100 +1,309 @@
 """
 Este script realiza un proceso de extracción, transformación y carga.
 Usa como fuente de datos los siguientes archivos: accident_20xx.csv, almacenados en el directorio: data/accident_data/*.csv.
+Los archivos se identifican por su nombre, de modo que basta con agregar los de nuevos años al directorio.
 Estos archivos fueron descargados manualmente de la página: https://www.nhtsa.gov/file-downloads?p=nhtsa/downloads/FARS/.
 Cada archivo contiene variables de los reportes de accidentes de transito generados por la Administración Nacional 
 de Seguridad del Tráfico en las Carreteras (NHTSA), por cada año
 
 Tambien se usa el archivo FRPP_GLC_-_United_States_may_9__2023.xlsx, almacenado en el directorio: data/additional_data
 y que fue descargado manualmente de: https://www.gsa.gov/reference/geographic-locator-codes/glcs-for-the-us-and-us-territories
-Esta archivo contiene el código y nombre de las condados y ciudades de los Estados Unidos
+Esta archivo contiene el código y nombre de las condados y ciudades de los Estados Unidos. Su contenido se guarda
+en formato binario en data/additional_data/glc_lookup, y solo se vuelve a leer cuando el archivo cambia
 
-Realizadas todas las operaciones se genera y exporta un archivo  denominado data_accident.pkl que se usará para implementar el dashboard
+Cada archivo se lee y transforma por bloques de filas, cuyo tamaño depende del límite de memoria (--max-memory),
+de modo que la memoria usada no crece con el número de años.
+
+Realizadas todas las operaciones se genera y exporta un conjunto de datos columnar (Arrow IPC) denominado data_accident,
+particionado por año, que se usará para implementar el dashboard. Tambien se exporta el directorio data_cube, con el
+conteo de accidentes y la suma de las variables de estudio por estado, año y cada una de las categorías de estudio
+
+Con la opción --incremental solo se procesan los archivos nuevos o modificados desde la ejecución anterior,
+según el manifiesto data_accident/_manifest.json, y se reemplaza únicamente la partición de su año
 """
 
+import argparse
+import itertools
+import logging
 import os
-import pandas as pd
+import shutil
+from collections import Counter
 
-from common import data_replace, read_data, replace_state_county_city
+from common import (map_codes, map_keys, load_glc, list_year_files, read_chunks, map_years, 
+                    enforce_schema, write_dataset, aggregate_cube, aggregate_rollup, merge_cubes, write_cube,
+                    read_cube, dataset_metadata, read_manifest, write_manifest, source_entry,
+                    dataset_version, write_snapshot, build_top_lists, write_top_lists, ROLLUP_LEVELS,
+                    validate_data, quality_columns, memory_report)
 from rename import (state_name, dayweek_name, month_name, 
                     weather, route, lgt_cond, 
-                    code_state, cols_filter, change_name)
+                    code_state, county_code_special, city_code_special,
+                    cols_filter, raw_dtypes, change_name, col_dtypes, ordinal_categories,
+                    cat_study, vars_study, sentinel_codes, value_ranges, coordinate_bounds, category_domains)
+from tracing import span, traced
 
 PATH = 'data'
+GLC_PATH = os.path.join(PATH, 'additional_data', 'FRPP_GLC_-_United_States_may_9__2023.xlsx')
+GLC_CACHE_PATH = os.path.join(PATH, 'additional_data', 'glc_lookup')
+DATASET_PATH = os.path.join(PATH, 'data_accident')
+CUBE_PATH = os.path.join(PATH, 'data_cube')
+ROLLUP_PATH = os.path.join(CUBE_PATH, '_rollup')
+MANIFEST_PATH = os.path.join(DATASET_PATH, '_manifest.json')
+
+# Memoria estimada, en bytes, por fila de un bloque: datos leídos, datos transformados y 
+# memoria temporal del lector de CSV
+ROW_BYTES = 1024
+
+# Versión del esquema de tipos de datos del conjunto exportado y de las tablas del cubo. Si cambia, la
+# ejecución incremental vuelve a procesar todos los años, para que todas las particiones compartan el esquema
+SCHEMA_VERSION = 4
+
+# Categorías de las que se calculan de antemano los valores con más accidentes (ver common.build_top_lists)
+TOP_CATEGORIES = ['County', 'City']
+
+# Columnas de códigos a reemplazar por sus nombres en los dataframes cuyos archivos 
+# solo contienen los códigos (años 2011-2014)
+names_replace = {'STATE': ('STATENAME', state_name),
+                 'DAY_WEEK': ('DAY_WEEKNAME', dayweek_name),
+                 'MONTH': ('MONTHNAME', month_name),
+                 'WEATHER': ('WEATHERNAME', weather),
+                 'ROUTE': ('ROUTENAME', route),
+                 'LGT_COND': ('LGT_CONDNAME', lgt_cond)}
+
+logger = logging.getLogger(__name__)
+
+def log_missing_codes(missing, year=None):
+    """
+    Logs the codes that could not be replaced by their names.
+
+    Args:
+        missing (dict): The codes without a name in each column, with their number of rows, as returned by map_codes.
+        year (int, optional): The year of the data, if the codes come from a single file.
+
+    Returns:
+        None
+    """
+    for col, codes in missing.items():
+        logger.warning('Códigos sin nombre en la columna %s%s: %s', 
+                       col, '' if year is None else f' ({year})', codes)
+
+def delete_year(year):
+    """
+    Deletes the partitions of a year from the dataset, from the cube and from its rollup store.
+
+    Args:
+        year (int or str): The year to delete.
+
+    Returns:
+        None
+    """
+    shutil.rmtree(os.path.join(DATASET_PATH, f'Year={year}'), ignore_errors=True)
+    for cat in cat_study:
+        shutil.rmtree(os.path.join(CUBE_PATH, cat, f'Year={year}'), ignore_errors=True)
+    for level in ROLLUP_LEVELS:
+        shutil.rmtree(os.path.join(ROLLUP_PATH, level, f'Year={year}'), ignore_errors=True)
 
-def main():
+def transform_chunk(data, county_names, city_names):
+    """
+    Transforms a chunk of raw accident data into the unified accident frame.
+
+    Args:
+        data (pandas.DataFrame): A chunk read from an accident_20xx.csv file. Its code columns are replaced in place.
+        county_names (pandas.DataFrame): The county lookup returned by load_glc.
+        city_names (pandas.DataFrame): The city lookup returned by load_glc.
+
+    Returns:
+        tuple: The data with readable column names and the declared data types, the codes
+            without a name in each source column, with their number of rows, and the memory
+            used by each column before and after applying the data types (see common.memory_report).
+    """
+    missing = {}
     
-    # Se cargan todos los archivos accident_20xx.csv, desde el 2011 a 2021
-    list_files = [name for name in os.listdir(os.path.join(PATH, 'accident_data'))]
+    # Se reemplaza los códigos por sus nombres, para normalizar los dataframes que no incluyen 
+    # las columnas con los nombres
+    if 'STATENAME' not in data.columns:
+        missing.update(map_codes(data, names_replace))
     
-    data_2011 = read_data(list_files[10:][1], os.path.join(PATH, 'accident_data'))
-    data_2012 = read_data(list_files[10:][2], os.path.join(PATH, 'accident_data'))
-    data_2013 = read_data(list_files[10:][3], os.path.join(PATH, 'accident_data'))
-    data_2014 = read_data(list_files[10:][4], os.path.join(PATH, 'accident_data'))
-    data_2015 = read_data(list_files[10:][5], os.path.join(PATH, 'accident_data'))
-    data_2016 = read_data(list_files[10:][6], os.path.join(PATH, 'accident_data'))
-    data_2017 = read_data(list_files[10:][7], os.path.join(PATH, 'accident_data'))
-    data_2018 = read_data(list_files[10:][8], os.path.join(PATH, 'accident_data'))
-    data_2019 = read_data(list_files[10:][9], os.path.join(PATH, 'accident_data'))
-    data_2020 = read_data(list_files[10:][10], os.path.join(PATH, 'accident_data'))
-    data_2021 = read_data(list_files[10:][11], os.path.join(PATH, 'accident_data'))
+    # Se agrega el código postal de cada estado
+    missing.update(map_codes(data, {'STATENAME': ('CODE_STATE', code_state)}))
     
-    # Se carga el archivo que contiene la información del código de las ciudades y condados
-    county_city_name = pd.read_excel(os.path.join(PATH, 'additional_data\\FRPP_GLC_-_United_States_may_9__2023.xlsx'))
+    # Se reemplaza los códigos de las ciudades y condados por sus nombres respectivos, buscando
+    # cada código junto con los del estado (y condado) al que pertenece. Las ciudades se reemplazan 
+    # primero, ya que su búsqueda usa el código del condado
+    missing['CITY'] = map_keys(data, ['STATE', 'COUNTY', 'CITY'], city_names, 'CITY', city_code_special)
+    missing['COUNTY'] = map_keys(data, ['STATE', 'COUNTY'], county_names, 'COUNTY', county_code_special)
     
-    # Se crea lista con los valores a reemplazar en los dataframes asociados a los accidentes
-    # ocurridos en el año 2021-2014
-    rows_replace = [state_name, dayweek_name, month_name, weather, route, lgt_cond, code_state]
+    # Se seleccionan las columnas de interés
+    data = data.loc[:, data.columns[data.columns.isin(cols_filter + ['CODE_STATE'])]]
     
-    # Se reemplaza los valores presentes en cada uno de los elementos de las listas, para normoalizar
-    # los dataframes
-    data_2011 = data_replace(data_2011, rows_replace)
-    data_2012 = data_replace(data_2012, rows_replace)
-    data_2013 = data_replace(data_2013, rows_replace)
-    data_2014 = data_replace(data_2014, rows_replace)
+    # Se transforma el nombre de las columnas a minúsculas
+    data.columns = [item.lower() for item in data.columns]
     
-    # Se seleccionan las columnas de interés
-    data_2011 = data_2011.loc[:, data_2011.columns[data_2011.columns.isin(cols_filter)]]
-    data_2012 = data_2012.loc[:, data_2012.columns[data_2012.columns.isin(cols_filter)]]
-    data_2013 = data_2013.loc[:, data_2013.columns[data_2013.columns.isin(cols_filter)]]
-    data_2014 = data_2014.loc[:, data_2014.columns[data_2014.columns.isin(cols_filter)]]
-    data_2015 = data_2015.loc[:, data_2015.columns[data_2015.columns.isin(cols_filter)]]
-    data_2016 = data_2016.loc[:, data_2016.columns[data_2016.columns.isin(cols_filter)]]
-    data_2017 = data_2017.loc[:, data_2017.columns[data_2017.columns.isin(cols_filter)]]
-    data_2018 = data_2018.loc[:, data_2018.columns[data_2018.columns.isin(cols_filter)]]
-    data_2019 = data_2019.loc[:, data_2019.columns[data_2019.columns.isin(cols_filter)]]
-    data_2020 = data_2020.loc[:, data_2020.columns[data_2020.columns.isin(cols_filter)]]
-    data_2021 = data_2021.loc[:, data_2021.columns[data_2021.columns.isin(cols_filter)]]
+    # Se reemplaza el nombre de las columnas a nombres legibles
+    data = data.rename(columns=change_name)
     
-    # Se concatenan los dataframes
-    data_join = pd.concat([data_2011,data_2012,data_2013,data_2014,data_2015,
-                           data_2016,data_2017,data_2018,data_2019,data_2020,data_2021])
+    # Se aplica el esquema de tipos de datos: categorías para las etiquetas y el ancho declarado
+    # para las variables numéricas, y se compara la memoria de las mismas columnas antes y después
+    typed = enforce_schema(data, col_dtypes, ordinal_categories)
+    return typed, {col: codes for col, codes in missing.items() if codes}, memory_report(data, typed)
+
+def process_year(year, item, path, county_names, city_names, partition_cols, chunksize):
+    """
+    Reads, transforms and exports the accident file of one year, one chunk at a time.
+
+    Only one chunk of the file is held in memory at any moment. Each transformed chunk
+    is written as a separate part of the year's partition, which must not exist yet.
+    The counts and sums of the year per category and per calendar period are accumulated
+    over the chunks and written to the cube and to its rollup store at the end.
+
+    Args:
+        year (int): The year of the file.
+        item (str): The name of the CSV file.
+        path (str): The path to the directory containing the CSV file.
+        county_names (pandas.DataFrame): The county lookup returned by load_glc.
+        city_names (pandas.DataFrame): The city lookup returned by load_glc.
+        partition_cols (tuple): The columns used to split the dataset.
+        chunksize (int): The number of rows of each chunk.
+
+    Returns:
+        dict: The number of rows, the bytes used by each column before and after applying the
+            data types (see common.memory_report), the codes without a name in each column, with
+            their number of rows, and the number of rows that break each data quality rule
+            (see common.validate_data).
+    """
+    summary = {'rows': 0, 'memory': None, 'missing': {}, 'violations': Counter()}
+    cubes = []
+    rollups = []
+    chunks = read_chunks(item, path, raw_dtypes, dtype=raw_dtypes, chunksize=chunksize)
+    for i in itertools.count():
+        with span('etl.read', year=year, part=i) as trace:
+            chunk = next(chunks, None)
+            trace.set(rows=0 if chunk is None else len(chunk))
+        if chunk is None:
+            break
+        with span('etl.transform', year=year, part=i, rows=len(chunk)):
+            data, missing, memory = transform_chunk(chunk, county_names, city_names)
+        del chunk
+        memory = memory[['before', 'after']]
+        summary['memory'] = memory if summary['memory'] is None else summary['memory'].add(memory, fill_value=0)
+        with span('etl.validate', year=year, part=i, rows=len(data)):
+            data, violations = validate_data(data, sentinel_codes, value_ranges, coordinate_bounds, category_domains)
+            summary['violations'].update(violations)
+        summary['rows'] += len(data)
+        for col, codes in missing.items():
+            counter = summary['missing'].setdefault(col, Counter())
+            counter.update(codes)
+        with span('etl.write', year=year, part=i, rows=len(data)):
+            write_dataset(data, DATASET_PATH, partition_cols=partition_cols, part=f'{i:05d}')
+        with span('etl.cube', year=year, part=i, rows=len(data)):
+            cubes.append(aggregate_cube(data, cat_study, vars_study))
+            rollups.append(aggregate_rollup(data, vars_study))
+    if cubes:
+        with span('etl.write_cube', year=year):
+            write_cube(merge_cubes(cubes), CUBE_PATH)
+            write_cube(merge_cubes(rollups), ROLLUP_PATH)
+        summary['memory']['ratio'] = (summary['memory']['before'] / summary['memory']['after']).round(1)
+    return summary
+
+@traced('etl.main')
+def main(workers=None, partition_cols=('Year',), incremental=False, max_memory=1024):
     
-    # Se crean diccionarios asociados al nombre del condado, ciudad y su código respectivo
-    county_name = [item.title() for item in county_city_name["County Name"].str.lower().unique()]
-    city_name = [item.title() for item in county_city_name["City Name"].str.lower().unique()]
+    # Se identifican todos los archivos accident_20xx.csv presentes en el directorio,
+    # a partir de su nombre, y se describe su contenido mediante un hash
+    path_accident = os.path.join(PATH, 'accident_data')
+    files = list_year_files(path_accident)
+    manifest = read_manifest(MANIFEST_PATH) if incremental else {}
+    previous = manifest.get('files', {})
+    sources = {str(year): source_entry(os.path.join(path_accident, item), previous.get(str(year)))
+               for year, item in files.items()}
+    glc = source_entry(GLC_PATH, manifest.get('glc'))
     
-    city_code_special = {0: "Not Applicable",
-                         9997: "Other",
-                         9898: "Not Reported",
-                         9999: "Unknown"}
-    county_name_code = dict(zip(county_city_name["County Code"].unique(), county_name))
-    city_name_code = dict(zip(county_city_name["City Code"].unique(), city_name))
-    city_name_code.update(city_code_special)
-    rows_replace.append(county_name_code)
-    rows_replace.append(city_name_code)
+    # Se procesan solo los años nuevos o modificados, salvo que haya cambiado el archivo de
+    # códigos de condados y ciudades, el particionado o el esquema, o que no se trate de una
+    # ejecución incremental
+    if incremental and manifest.get('glc', {}).get('sha256') == glc['sha256'] \
+            and tuple(manifest.get('partition_cols', ())) == tuple(partition_cols) \
+            and manifest.get('schema_version') == SCHEMA_VERSION:
+        years = [year for year in files 
+                 if previous.get(str(year), {}).get('sha256') != sources[str(year)]['sha256']]
+        for year in set(previous) - set(sources):
+            logger.info('Se elimina la partición del año %s, cuyo archivo ya no existe', year)
+            delete_year(year)
+    else:
+        years = list(files)
+        shutil.rmtree(DATASET_PATH, ignore_errors=True)
+        shutil.rmtree(CUBE_PATH, ignore_errors=True)
+    logger.info('Años a procesar: %s', years)
     
-    # Se reemplaza los códigos de los condados y ciudades por sus nombres respectivos
-    data_join = replace_state_county_city(data_join, rows_replace)
+    if years:
+        # Se cargan las tablas de nombres de los condados y ciudades, que solo se generan a partir
+        # del archivo de códigos cuando este ha cambiado
+        county_names, city_names = load_glc(GLC_PATH, GLC_CACHE_PATH)
+        
+        # Se reparte el límite de memoria entre los procesos para fijar el número de filas
+        # que cada uno lee a la vez
+        workers = min(workers or os.cpu_count() or 1, len(years))
+        chunksize = max(1000, max_memory * 2**20 // (workers * ROW_BYTES))
+        logger.info('Procesos: %d, filas por bloque: %d', workers, chunksize)
+        
+        # Se eliminan las particiones de los años a procesar, que se vuelven a escribir por bloques
+        for year in years:
+            delete_year(year)
+        
+        # Se procesan en paralelo los archivos de los años, exportando cada bloque en formato columnar
+        # a la partición de su año (y opcionalmente de su estado), junto con el conteo de accidentes y
+        # la suma de las variables de estudio por estado, año y categoría
+        summaries = map_years(process_year, {year: files[year] for year in years}, workers=workers,
+                              path=path_accident, county_names=county_names, city_names=city_names,
+                              partition_cols=partition_cols, chunksize=chunksize)
+        for year, summary in summaries.items():
+            memory = summary['memory']
+            if memory is not None:
+                logger.info('Año %s: %d filas, memoria antes y después del esquema %d -> %d bytes', 
+                            year, summary['rows'], memory.loc['Total', 'before'], memory.loc['Total', 'after'])
+                logger.debug('Año %s: memoria por columna\n%s', year, memory.to_string())
+            log_missing_codes(summary['missing'], year)
+            if summary['violations']:
+                logger.warning('Año %s: filas que no cumplen las reglas de calidad: %s', year, dict(summary['violations']))
     
-    # Se transforma el nombre de las columnas a minúsculas
-    data_join.columns = [item.lower() for item in data_join.columns]
+    # Se calculan, a partir del cubo, los condados y ciudades con más accidentes y con mayor suma
+    # de cada variable de estudio, con los que el dashboard responde sus rankings sin agrupar el cubo
+    if os.path.exists(CUBE_PATH):
+        with span('etl.top_lists'):
+            cube = read_cube(CUBE_PATH, TOP_CATEGORIES)
+            write_top_lists({cat: build_top_lists(cube[cat], cat, ['Total accidents'] + vars_study)
+                             for cat in TOP_CATEGORIES}, CUBE_PATH)
     
-    # Se reemplaza el nombre de las columnas a nombres legibles
-    data_join = data_join.rename(columns=change_name)
+    # Se actualiza el manifiesto con los archivos procesados, con los estados y años disponibles,
+    # que el dashboard usa para las opciones de filtro sin leer el conjunto de datos, y con el
+    # número de filas de cada año que no cumplen las reglas de calidad
+    os.makedirs(DATASET_PATH, exist_ok=True)
+    metadata = dataset_metadata(read_cube(CUBE_PATH, ['State'])) if os.path.exists(CUBE_PATH) else None
+    violations = {year: counts for year, counts in manifest.get('quality', {}).get('violations', {}).items()
+                  if year in sources}
+    if years:
+        violations.update({str(year): dict(summary['violations']) for year, summary in summaries.items()})
+    quality = {'columns': quality_columns(sentinel_codes, value_ranges, coordinate_bounds, category_domains),
+               'violations': dict(sorted(violations.items()))}
+    write_manifest(MANIFEST_PATH, {'files': sources, 'glc': glc, 'partition_cols': list(partition_cols),
+                                   'schema_version': SCHEMA_VERSION, 'metadata': metadata, 'quality': quality})
     
-    # Se exporta el conjunto de datos en formato pickle
-    data_join.to_pickle(os.path.join(PATH, "data_accident.pkl"))  
+    # Se escribe la copia de todas las columnas en un único archivo, que los procesos del dashboard
+    # mapean en memoria y comparten, sin tener que leer las particiones
+    write_snapshot(DATASET_PATH, dataset_version(DATASET_PATH))
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='ETL de los reportes de accidentes de la NHTSA')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Número de procesos para leer los archivos (por defecto uno por CPU)')
+    parser.add_argument('--partition-state', action='store_true',
+                        help='Particiona el conjunto de datos por año y estado')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Procesa solo los archivos nuevos o modificados desde la ejecución anterior')
+    parser.add_argument('--max-memory', type=int, default=1024,
+                        help='Límite aproximado de memoria, en MB, para los bloques leídos por todos los procesos')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(workers=args.workers,
+         partition_cols=('Year', 'State') if args.partition_state else ('Year',),
+         incremental=args.incremental,
+         max_memory=args.max_memory)
@@ -1,16 +1,97 @@
-import pandas as pd
+import os
+import numpy as np
 import plotly.express as px
-from common import replace_name
-import streamlit as st
-import pydeck as pdk 
+import plotly.io as pio
+from common import (select_rows, intersect_rows, query_radius, cache_result, disk_cache, 
+                    bin_size, hex_bin, sum_state_totals)
+from queries import query_frame
+from tracing import span, traced
 
-@st.cache_data
-def count_graph(data, state_filter, year_filter, cat_filter):    
+# Directorio y tamaño máximo, en bytes, de la caché en disco de las figuras, compartida por
+# todos los procesos del servidor
+FIGURE_CACHE_PATH = os.environ.get('FIGURE_CACHE_PATH', os.path.join('data', 'figure_cache'))
+FIGURE_CACHE_BYTES = int(os.environ.get('FIGURE_CACHE_BYTES', 512 * 2**20))
+
+figure_cache = disk_cache(FIGURE_CACHE_PATH, FIGURE_CACHE_BYTES, dumps=pio.to_json, loads=pio.from_json)
+
+def figure_cache_info():
+    """
+    Returns the statistics of the disk cache of each figure function.
+
+    Returns:
+        dict: The cache_info() of the disk cache of each function, keyed by its name.
+    """
+    return {name: func.cache_info() for name, func in figure_cache.functions.items()}
+
+# Tamaño, en pixeles, de los hexágonos del mapa de accidentes, y número máximo de accidentes
+# que se dibujan individualmente sobre los hexágonos
+MAP_BIN_PIXELS = 4
+MAP_RAW_POINTS = 20000
+
+# Número de filas a partir del cual el gráfico de dispersión agrupa los puntos repetidos 
+# y se dibuja con WebGL
+SCATTER_WEBGL_ROWS = 5000
+
+# Si se define, las agregaciones del cubo se consultan al servicio query_service.py en lugar de
+# calcularse en cada proceso del dashboard
+QUERY_SERVICE_URL = os.environ.get('QUERY_SERVICE_URL')
+
+# Categorías de las que solo se muestran los 20 valores con más accidentes
+TOP_CATEGORIES = ['State', 'County', 'City']
+
+def filter_rows(data, index, state_filter, year_filter, area_rows=None):
+    """
+    Selects the rows of the given states and years.
+
+    Args:
+        data (pandas.DataFrame): The accident data.
+        index (dict or None): The State and Year row index of data (see common.build_row_index).
+            If None, the rows are filtered by comparing the columns.
+        state_filter (list): The states to keep.
+        year_filter (list): The years to keep, as integers.
+        area_rows (numpy.ndarray, optional): The sorted positions of the rows inside an area
+            (see common.query_radius). If provided, only these rows are kept.
+
+    Returns:
+        pandas.DataFrame: The selected rows.
+    """
+    if index is None:
+        mask = (data['State'].isin(state_filter)) & (data['Year'].isin(year_filter))
+        rows = np.flatnonzero(mask.to_numpy())
+    else:
+        rows = select_rows(index, State=state_filter, Year=year_filter)
+    if area_rows is not None:
+        rows = intersect_rows(rows, area_rows)
+    return data if isinstance(rows, slice) else data.take(rows)
+
+def area_rows(spatial, area):
+    """
+    Finds the rows within a distance of a point, if an area is given.
+
+    Args:
+        spatial (dict or None): The spatial index of the data (see common.build_spatial_index).
+        area (tuple or None): The longitude and latitude of the point and the distance, in kilometers.
+
+    Returns:
+        numpy.ndarray or None: The sorted positions of the rows in the area, or None if no area is given.
+    """
+    if area is None:
+        return None
+    if spatial is None:
+        raise ValueError('A spatial index is required to filter by area')
+    lon, lat, km = area
+    return query_radius(spatial, lon, lat, km)
+
+@traced()
+@cache_result(maxsize=64)
+@figure_cache
+def count_graph(_cube, version, state_filter, year_filter, cat_filter):    
     """
     Generate a bar graph showing the total accidents based on filters.
 
     Parameters:
-    - data: Pandas DataFrame containing accident data
+    - _cube: Dictionary of Pandas DataFrames with the accident counts per State, Year and category (see common.aggregate_cube)
+    - version: Version of the dataset the cube was built from, used as the cache key (see common.dataset_version)
     - state_filter: Filter for specific state(s) (string or list of strings)
     - year_filter: Filter for specific year(s) (string or list of strings)
     - cat_filter: Filter for specific category (string)
@@ -25,52 +106,60 @@ def count_graph(data, state_filter, year_filter, cat_filter):
         year_filter = [year_filter]
     year_filter = [int(item) for item in year_filter]
                
-    year_count = data[(data['State'].isin(state_filter)) & (data['Year'].isin(year_filter))][cat_filter].value_counts().to_frame().reset_index()
-    year_count.columns = [cat_filter, 'Total accidents']
-
-    year_count = replace_name(year_count, cat_filter)
-    
-    if cat_filter == 'City':
-        year_count = year_count[year_count[cat_filter] != "Not Applicable"]
-
-    if cat_filter in ['State', 'County', 'City']:
-        year_count = year_count.sort_values(by='Total accidents', ascending=False).head(20)
+    with span('count_graph.aggregate', category=cat_filter) as trace:
+        query = {'query': 'count', 'category': cat_filter, 'states': state_filter, 'years': year_filter,
+                 'top': 20 if cat_filter in TOP_CATEGORIES else None}
+        year_count = query_frame(_cube, version, query, url=QUERY_SERVICE_URL)
+        trace.set(rows=len(year_count))
           
-    fig_count = px.bar(year_count, 
-                      x=cat_filter, 
-                      y='Total accidents', 
-                      width=900, 
-                      height=600,
-                       color_discrete_sequence = ['#2e62f2'],
-                       text=[f'{i}' for i in year_count['Total accidents']]
-                      )
-    fig_count.update_traces(textfont_color='#f2f4fa',
-                            textposition='outside')
-
-    fig_count.update_layout(
-        margin=dict(l=30, r=30, t=30, b=20),
-        paper_bgcolor="#18181a",
-        font=dict(family = 'sans-serif', color='#f2f4fa', size=14),
-        plot_bgcolor='#18181a',
-        xaxis=dict(showgrid=False),
-        yaxis=dict(showgrid=False),
-        hoverlabel_font_color='#f2f4fa'
-    )
+    with span('count_graph.figure'):
+        fig_count = px.bar(year_count, 
+                          x=cat_filter, 
+                          y='Total accidents', 
+                          width=900, 
+                          height=600,
+                           color_discrete_sequence = ['#2e62f2'],
+                           text=[f'{i}' for i in year_count['Total accidents']]
+                          )
+        fig_count.update_traces(textfont_color='#f2f4fa',
+                                textposition='outside')
+
+        fig_count.update_layout(
+            margin=dict(l=30, r=30, t=30, b=20),
+            paper_bgcolor="#18181a",
+            font=dict(family = 'sans-serif', color='#f2f4fa', size=14),
+            plot_bgcolor='#18181a',
+            xaxis=dict(showgrid=False),
+            yaxis=dict(showgrid=False),
+            hoverlabel_font_color='#f2f4fa'
+        )
     return fig_count
 
 
-@st.cache_data
-def scatter_graph(data, year_filter, state_filter, x_var, y_var, z_var): 
+@traced()
+@cache_result(maxsize=64)
+@figure_cache
+def scatter_graph(_data, version, year_filter, state_filter, x_var, y_var, z_var, _index=None,
+                  webgl_rows=SCATTER_WEBGL_ROWS): 
     """
     Generates a scatter graph based on the provided data and filters.
 
+    When the selection has more than webgl_rows rows, the accidents with the same state and
+    the same values of x_var and y_var are drawn as a single point, whose size is the sum of
+    z_var, and the graph is drawn with WebGL. The variables are small integers, so the number
+    of points stays bounded whatever the size of the selection.
+
     Parameters:
-    - data (pandas.DataFrame): The input data containing the required columns.
+    - _data (pandas.DataFrame): The input data containing the required columns.
+    - version (str): The version of the data, used as the cache key (see common.dataset_version).
     - year_filter (int or list): The year(s) to filter the data by.
     - state_filter (str or list): The state(s) to filter the data by.
     - x_var (str): The column name representing the x-axis variable.
     - y_var (str): The column name representing the y-axis variable.
     - z_var (str): The column name representing the size variable for markers.
+    - _index (dict, optional): The State and Year row index of data (see common.build_row_index).
+      If not provided, the rows are filtered by comparing the columns.
+    - webgl_rows (int, optional): The number of rows above which the points are grouped. Default is SCATTER_WEBGL_ROWS.
 
     Returns:
     - fig_scatter (plotly.graph_objects.Figure): Scatter graph figure.
@@ -78,105 +167,196 @@ def scatter_graph(data, year_filter, state_filter, x_var, y_var, z_var):
     if isinstance(year_filter, list) == False:
         year_filter = [year_filter]
     year_filter = [int(item) for item in year_filter]
-    year_filter = tuple(year_filter)
     
     if isinstance(state_filter, list) == False:
         state_filter = [state_filter]
                 
-    data = data[(data['State'].isin(state_filter))]
+    with span('scatter_graph.filter') as trace:
+        data = filter_rows(_data, _index, state_filter, year_filter)
+        trace.set(rows=len(data))
     
-    fig_scatter = px.scatter(
-        data.query(f'Year in {year_filter}'),
-        x=x_var,
-        y=y_var,
-        size=z_var,
-        color="State",
-        size_max=60,
-        width=800, 
-        height=400)
-
-    fig_scatter.update_layout(
-        margin=dict(l=30, r=30, t=30, b=20),
-        paper_bgcolor="#18181a",
-        font=dict(family = 'sans-serif', color='#f2f4fa', size=12),
-        plot_bgcolor='#18181a',
-        xaxis=dict(showgrid=False),
-        yaxis=dict(showgrid=False),
-        hoverlabel_font_color='#f2f4fa'
-    ) 
+    with span('scatter_graph.figure', webgl=len(data) > webgl_rows):
+        if len(data) > webgl_rows:
+            # Se agrupan los accidentes con los mismos valores, ponderados por la suma de z_var
+            grouped = data.groupby(list(dict.fromkeys(['State', x_var, y_var])), observed=True)
+            points = grouped.size().rename('Total accidents').reset_index()
+            size_var = f'{z_var} (total)'
+            points[size_var] = grouped[z_var].sum().to_numpy()
+            fig_scatter = px.scatter(
+                points,
+                x=x_var,
+                y=y_var,
+                size=size_var,
+                color="State",
+                hover_data=['Total accidents'],
+                size_max=60,
+                render_mode='webgl',
+                width=800, 
+                height=400)
+        else:
+            fig_scatter = px.scatter(
+                data,
+                x=x_var,
+                y=y_var,
+                size=z_var,
+                color="State",
+                size_max=60,
+                width=800, 
+                height=400)
+
+        fig_scatter.update_layout(
+            margin=dict(l=30, r=30, t=30, b=20),
+            paper_bgcolor="#18181a",
+            font=dict(family = 'sans-serif', color='#f2f4fa', size=12),
+            plot_bgcolor='#18181a',
+            xaxis=dict(showgrid=False),
+            yaxis=dict(showgrid=False),
+            hoverlabel_font_color='#f2f4fa'
+        ) 
     return fig_scatter
 
-@st.cache_data
-def map_accident(data, state_filter, year_filter, var_filter):
+@traced()
+@cache_result(maxsize=64)
+def map_accident(_data, version, state_filter, year_filter, var_filter, _index=None, 
+                 zoom=7, bin_pixels=MAP_BIN_PIXELS, raw_points=MAP_RAW_POINTS, area=None, _spatial=None):
     """
     Generates a map visualization of accidents using the specified data and filters.
 
+    The accidents are grouped into hexagons in Python, so the map only receives the center
+    of each hexagon with its number of accidents and the sum of var_filter. The size of the
+    hexagons follows the zoom level. The individual accidents are drawn only when there are
+    at most raw_points of them. The map can be limited to the accidents within a distance of
+    a point, in which case several states can be selected.
+
     Args:
-        data (pandas.DataFrame): The data to be used for the map visualization.
+        _data (pandas.DataFrame): The data to be used for the map visualization.
+        version (str): The version of the data, used as the cache key (see common.dataset_version).
         state_filter (str or list): The state or states to filter the data by.
         year_filter (int or list): The year or years to filter the data by.
-        var_filter (str): The variable used to determine the elevation range of the markers.
+        var_filter (str): The variable summed in each hexagon, which sets its height.
+        _index (dict, optional): The State and Year row index of data (see common.build_row_index).
+            If not provided, the rows are filtered by comparing the columns.
+        zoom (int, optional): The zoom level of the map. Default is 7.
+        bin_pixels (int, optional): The size of the hexagons, in pixels at the given zoom. Default is MAP_BIN_PIXELS.
+        raw_points (int, optional): The maximum number of accidents drawn individually. Default is MAP_RAW_POINTS.
+        area (tuple, optional): The longitude and latitude of a point and a distance, in kilometers.
+            If provided, only the accidents within that distance of the point are drawn.
+        _spatial (dict, optional): The spatial index of data (see common.build_spatial_index),
+            required when area is provided.
 
     Returns:
-        None
+        pydeck.Deck: The map, or None if more than one state is selected without an area.
     """    
-    if isinstance(state_filter, list) == False:
+    if isinstance(state_filter, list) == False or area is not None:
 
+        if isinstance(state_filter, list) == False:
+            state_filter = [state_filter]
         if isinstance(year_filter, list) == False:
             year_filter = [year_filter]
         year_filter = [int(item) for item in year_filter]
         
-        data_filter = data[(data['State'].isin([state_filter])) & (data['Year'].isin(year_filter))]
-    
-        val_min = data_filter[var_filter].min()
-        val_max = data_filter[var_filter].max()
+        with span('map_accident.filter') as trace:
+            data_filter = filter_rows(_data, _index, state_filter, year_filter, area_rows(_spatial, area))
+            data_filter = data_filter.rename(columns={'longitud': 'longitude'})
+            trace.set(rows=len(data_filter))
+        
+        if area is not None:
+            val_long, val_lat = area[0], area[1]
+        else:
+            val_long = data_filter['longitude'].describe().iloc[5]
+            val_lat = data_filter['latitude'].describe().iloc[5]
+        
+        # pydeck solo se importa cuando se visualiza el mapa
+        import pydeck as pdk
         
-        data_filter = data_filter.rename(columns={'longitud': 'longitude'})
-        data_filter = data_filter.loc[:, ['latitude', 'longitude']]
+        # Se agrupan los accidentes en hexágonos cuyo tamaño depende del nivel de zoom
+        with span('map_accident.bin') as trace:
+            size = bin_size(zoom, val_lat, bin_pixels)
+            bins = hex_bin(data_filter['longitude'], data_filter['latitude'], data_filter[var_filter], size)
+            val_max = bins['value'].max() if len(bins) else 0
+            bins['weight'] = bins['value'] / val_max if val_max > 0 else 0.0
+            bins['elevation'] = bins['weight'] * size * 20
+            trace.set(rows=len(bins))
         
-        val_long = data_filter['longitude'].describe().iloc[5]
-        val_lat = data_filter['latitude'].describe().iloc[5]
+        layers = [
+            pdk.Layer(
+               'ColumnLayer',
+               data=bins,
+               get_position='[longitude, latitude]',
+               get_elevation='elevation',
+               get_fill_color='[255, 255 * (1 - weight), 64, 200]',
+               radius=size,
+               disk_resolution=6,
+               extruded=True,
+               pickable=True,
+               auto_highlight=True,
+            ),
+        ]
+        if len(data_filter) <= raw_points:
+            layers.append(
+                pdk.Layer(
+                   'ScatterplotLayer',
+                   data=data_filter.loc[:, ['latitude', 'longitude']].dropna(),
+                   get_position='[longitude, latitude]',
+                   get_fill_color='[255, 64, 128, 200]',
+                   get_radius=150,
+                ))
         
-        st.pydeck_chart(pdk.Deck(
+        return pdk.Deck(
             map_style='mapbox://styles/mapbox/dark-v11',
             initial_view_state=pdk.ViewState(
                 latitude=val_lat,
                 longitude=val_long,
-                zoom=7,
+                zoom=zoom,
                 min_zoom=5,
                 max_zoom=15,
                 pitch=45,
                 bearing=-45
             ),
-            layers=[
-                pdk.Layer(
-                  'HexagonLayer',
-                   data=data_filter,
-                   get_position='[longitude, latitude]',
-                   radius=150,
-                   elevation_scale=int(val_max)*5,
-                   elevation_range=[int(val_min), int(val_max)],
-                   extruded=True,
-                ),
-                pdk.Layer(
-                   'ScatterplotLayer',
-                   data=data_filter,
-                   get_position='[longitude, latitude]',
-                   get_fill_color='[255, 64, 128, 200]',
-                   get_radius=150,
-                   auto_highlight=True,
-                ),
-            ],
-        ))
+            layers=layers,
+            tooltip={'text': f'Accidentes: {{count}}\n{var_filter}: {{value}}'},
+        )
 
 
-@st.cache_data        
-def sum_stats_study(data, state_filter, year_filter, study_stats, cat_filter):
+@traced()
+@cache_result(maxsize=64)
+def area_stats(_data, version, state_filter, year_filter, var_filter, area, _index=None, _spatial=None):
+    """
+    Counts the accidents within a distance of a point and sums a variable over them.
+
+    Args:
+        _data (pandas.DataFrame): The accident data.
+        version (str): The version of the data, used as the cache key (see common.dataset_version).
+        state_filter (str or list): The state or states to filter the data by.
+        year_filter (int or list): The year or years to filter the data by.
+        var_filter (str): The variable to sum.
+        area (tuple): The longitude and latitude of the point and the distance, in kilometers.
+        _index (dict, optional): The State and Year row index of data (see common.build_row_index).
+        _spatial (dict): The spatial index of data (see common.build_spatial_index).
+
+    Returns:
+        dict: The number of accidents ('count') and the sum of var_filter ('sum').
+    """
+    if isinstance(state_filter, list) == False:
+        state_filter = [state_filter]
+    if isinstance(year_filter, list) == False:
+        year_filter = [year_filter]
+    year_filter = [int(item) for item in year_filter]
+    
+    with span('area_stats.filter'):
+        data_filter = filter_rows(_data, _index, state_filter, year_filter, area_rows(_spatial, area))
+    return {'count': len(data_filter), 'sum': int(data_filter[var_filter].sum())}
+
+@traced()
+@cache_result(maxsize=64)
+@figure_cache
+def sum_stats_study(_cube, version, state_filter, year_filter, study_stats, cat_filter):
     """
     Calculates and visualizes summary statistics based on specified filters.
 
     Args:
-        data (pandas.DataFrame): The data used for the analysis.
+        _cube (dict): The sums per State, Year and category used for the analysis (see common.aggregate_cube).
+        version (str): The version of the dataset the cube was built from, used as the cache key (see common.dataset_version).
         state_filter (str or list): The state or states to filter the data by.
         year_filter (int or list): The year or years to filter the data by.
         study_stats (str): The statistics to be calculated.
@@ -192,49 +372,46 @@ def sum_stats_study(data, state_filter, year_filter, study_stats, cat_filter):
         year_filter = [year_filter]
     year_filter = [int(item) for item in year_filter]
     
-    sum_stats = data[(data['Year'].isin(year_filter)) & (data['State'].isin(state_filter))].groupby([cat_filter]).sum(numeric_only=True)[study_stats]
-
-    sum_stats = pd.DataFrame(sum_stats)
-    sum_stats.reset_index(inplace=True)        
-
-    sum_stats = replace_name(sum_stats, cat_filter)
-
-    if cat_filter == 'City':
-        sum_stats = sum_stats[sum_stats[cat_filter] != "Not Applicable"]
-      
-    if cat_filter in ['State', 'County', 'City']:
-        sum_stats = sum_stats.sort_values(by=study_stats, ascending=False).head(20)
-
-    fig_sum = px.bar(sum_stats, 
-                      x=cat_filter, 
-                      y=study_stats, 
-                      width=600, 
-                      height=500,
-                      text=[f'{i}' for i in sum_stats[study_stats]],
-                      color_discrete_sequence =['#AD8317'])
-
-    fig_sum.update_traces(textfont_color='#f2f4fa',
-                            textposition='outside')
-
-    fig_sum.update_layout(
-        margin=dict(l=60, r=20, t=60, b=80),
-        paper_bgcolor="#18181a",
-        font=dict(family='sans-serif', color='#f2f4fa', size=14),
-        plot_bgcolor='#18181a',
-        xaxis=dict(showgrid=False),
-        yaxis=dict(showgrid=False),
-        hoverlabel_font_color='#f2f4fa'
-    )
+    with span('sum_stats_study.aggregate', category=cat_filter) as trace:
+        query = {'query': 'sum', 'category': cat_filter, 'measure': study_stats, 'states': state_filter, 
+                 'years': year_filter, 'top': 20 if cat_filter in TOP_CATEGORIES else None}
+        sum_stats = query_frame(_cube, version, query, url=QUERY_SERVICE_URL)
+        trace.set(rows=len(sum_stats))
+
+    with span('sum_stats_study.figure'):
+        fig_sum = px.bar(sum_stats, 
+                          x=cat_filter, 
+                          y=study_stats, 
+                          width=600, 
+                          height=500,
+                          text=[f'{i}' for i in sum_stats[study_stats]],
+                          color_discrete_sequence =['#AD8317'])
+
+        fig_sum.update_traces(textfont_color='#f2f4fa',
+                                textposition='outside')
+
+        fig_sum.update_layout(
+            margin=dict(l=60, r=20, t=60, b=80),
+            paper_bgcolor="#18181a",
+            font=dict(family='sans-serif', color='#f2f4fa', size=14),
+            plot_bgcolor='#18181a',
+            xaxis=dict(showgrid=False),
+            yaxis=dict(showgrid=False),
+            hoverlabel_font_color='#f2f4fa'
+        )
     
     return fig_sum
 
-@st.cache_data
-def choropleth_graph(data, year_filter, var_filter):
+@traced()
+@cache_result(maxsize=64)
+@figure_cache
+def choropleth_graph(_totals, version, year_filter, var_filter):
     """
     Generates a choropleth graph using the specified data and filters.
 
     Args:
-        data (pandas.DataFrame): The data to be used for the choropleth graph.
+        _totals (dict): The totals per State and Year to be used for the choropleth graph (see common.build_state_totals).
+        version (str): The version of the dataset the totals were built from, used as the cache key (see common.dataset_version).
         year_filter (int or list): The year or years to filter the data by.
         var_filter (str): The variable to be plotted on the choropleth map.
 
@@ -245,32 +422,128 @@ def choropleth_graph(data, year_filter, var_filter):
         year_filter = [year_filter]
     year_filter = [int(item) for item in year_filter]
     
-    code_state = data['code_state'].unique()
-    name_state = data['State'].unique()
-    code_name = dict(zip(name_state, code_state))
+    with span('choropleth_graph.aggregate'):
+        data_mean = sum_state_totals(_totals, year_filter, var_filter)
+
+    with span('choropleth_graph.figure'):
+        fig_map = px.choropleth(data_mean,
+                                locations='code_state',
+                                color=var_filter,
+                                color_continuous_scale='hot',
+                                hover_name='State',
+                                locationmode='USA-states',
+                                scope='usa')
+
+        fig_map.update_layout(
+            margin=dict(l=30, r=30, t=30, b=20),
+            paper_bgcolor="#18181a",
+            font=dict(family = 'sans-serif', color='#f2f4fa', size=14),
+            plot_bgcolor='#18181a',
+            xaxis=dict(showgrid=False),
+            yaxis=dict(showgrid=False),
+            hoverlabel_font_color='#f2f4fa',
+            geo=dict(bgcolor='#18181a')
+        )
+
+    return fig_map
+
+@traced()
+@cache_result(maxsize=64)
+@figure_cache
+def trend_graph(_cube, version, state_filter, year_filter, study_stats, level):
+    """
+    Generates a line graph of a variable per calendar period, from the rollup store of the cube.
 
-    data_mean = data[(data['Year'].isin(year_filter))].groupby('State').sum(numeric_only=True).reset_index()
-    
-    data_mean['code_state'] = data_mean['State']
-    data_mean['code_state'] = data_mean['code_state'].replace(code_name)
-
-    fig_map = px.choropleth(data_mean,
-                            locations='code_state',
-                            color=var_filter,
-                            color_continuous_scale='hot',
-                            hover_name='State',
-                            locationmode='USA-states',
-                            scope='usa')
-
-    fig_map.update_layout(
-        margin=dict(l=30, r=30, t=30, b=20),
-        paper_bgcolor="#18181a",
-        font=dict(family = 'sans-serif', color='#f2f4fa', size=14),
-        plot_bgcolor='#18181a',
-        xaxis=dict(showgrid=False),
-        yaxis=dict(showgrid=False),
-        hoverlabel_font_color='#f2f4fa',
-        geo=dict(bgcolor='#18181a')
-    )
-
-    return fig_map
\ No newline at end of file
+    Args:
+        _cube (dict): The cube of the dataset, with its rollup store (see common.read_cube).
+        version (str): The version of the dataset the cube was built from, used as the cache key (see common.dataset_version).
+        state_filter (str or list): The state or states to filter the data by.
+        year_filter (int or list): The year or years to filter the data by.
+        study_stats (str): The variable to add up, or 'Total accidents'.
+        level (str): The calendar period: 'year', 'quarter', 'month', 'week' or 'day'.
+
+    Returns:
+        plotly.graph_objects.Figure: The line graph figure.
+    """
+    if isinstance(state_filter, list) == False:
+        state_filter = [state_filter]
+
+    if isinstance(year_filter, list) == False:
+        year_filter = [year_filter]
+    year_filter = [int(item) for item in year_filter]
+
+    with span('trend_graph.aggregate', level=level) as trace:
+        query = {'query': 'trend', 'level': level, 'measure': study_stats, 'states': state_filter, 'years': year_filter}
+        data_trend = query_frame(_cube, version, query, url=QUERY_SERVICE_URL)
+        trace.set(rows=len(data_trend))
+
+    with span('trend_graph.figure'):
+        fig_trend = px.line(data_trend, 
+                            x='Period', 
+                            y=study_stats, 
+                            width=900, 
+                            height=500,
+                            color_discrete_sequence=['#2e62f2'])
+
+        fig_trend.update_layout(
+            margin=dict(l=30, r=30, t=30, b=20),
+            paper_bgcolor="#18181a",
+            font=dict(family='sans-serif', color='#f2f4fa', size=14),
+            plot_bgcolor='#18181a',
+            xaxis=dict(showgrid=False),
+            yaxis=dict(showgrid=False),
+            hoverlabel_font_color='#f2f4fa'
+        )
+    return fig_trend
+
+@traced()
+@cache_result(maxsize=64)
+@figure_cache
+def heatmap_graph(_cube, version, state_filter, year_filter, study_stats):
+    """
+    Generates a heatmap of a variable per hour of the day and day of the week, from the rollup store of the cube.
+
+    Args:
+        _cube (dict): The cube of the dataset, with its rollup store (see common.read_cube).
+        version (str): The version of the dataset the cube was built from, used as the cache key (see common.dataset_version).
+        state_filter (str or list): The state or states to filter the data by.
+        year_filter (int or list): The year or years to filter the data by.
+        study_stats (str): The variable to add up, or 'Total accidents'.
+
+    Returns:
+        plotly.graph_objects.Figure: The heatmap figure.
+    """
+    if isinstance(state_filter, list) == False:
+        state_filter = [state_filter]
+
+    if isinstance(year_filter, list) == False:
+        year_filter = [year_filter]
+    year_filter = [int(item) for item in year_filter]
+
+    with span('heatmap_graph.aggregate') as trace:
+        query = {'query': 'trend', 'level': 'hour', 'by': 'Day of week', 'measure': study_stats, 
+                 'states': state_filter, 'years': year_filter}
+        data_hour = query_frame(_cube, version, query, url=QUERY_SERVICE_URL)
+        # Las horas desconocidas (código 99) no se muestran
+        data_hour = data_hour[data_hour['Hour'] < 24]
+        # Las filas llegan ordenadas por día de la semana y hora, por lo que la tabla conserva ese orden
+        grid = data_hour.pivot(index='Day of week', columns='Hour', values=study_stats)
+        grid = grid.reindex(list(dict.fromkeys(data_hour['Day of week'])))
+        trace.set(rows=len(data_hour))
+
+    with span('heatmap_graph.figure'):
+        fig_heat = px.imshow(grid, 
+                             color_continuous_scale='hot',
+                             aspect='auto',
+                             width=900, 
+                             height=450,
+                             labels=dict(x='Hour', y='Day of week', color=study_stats))
+
+        fig_heat.update_layout(
+            margin=dict(l=30, r=30, t=30, b=20),
+            paper_bgcolor="#18181a",
+            font=dict(family='sans-serif', color='#f2f4fa', size=14),
+            plot_bgcolor='#18181a',
+            hoverlabel_font_color='#f2f4fa'
+        )
+    return fig_heat
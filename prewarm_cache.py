@@ -0,0 +1,83 @@
+"""
+Este script genera de antemano las figuras del dashboard para las combinaciones de filtros más
+frecuentes, y las guarda en la caché en disco de las figuras (graphs.FIGURE_CACHE_PATH), que
+comparten todos los procesos del servidor. Se debe ejecutar después del proceso de ETL, ya que
+las figuras guardadas corresponden a la versión actual de data/data_accident
+
+Por defecto se generan, para todos los estados y para cada estado, con todos los años y con cada año,
+las figuras que se muestran al abrir cada vista del dashboard: el conteo por año, el conteo y la suma
+por la primera categoría, y la dispersión de la primera variable. Con la opción --full se generan
+también el conteo y la suma por cada categoría y variable, para todos los estados
+"""
+
+import argparse
+import logging
+import os
+import time
+
+from common import (read_dataset, read_cube, read_manifest, dataset_metadata, dataset_version,
+                    build_row_index, build_state_totals)
+from graphs import count_graph, scatter_graph, sum_stats_study, choropleth_graph, figure_cache_info
+from rename import cat_study, vars_study, code_state
+
+PATH = os.path.join('data', 'data_accident')
+PATH_CUBE = os.path.join('data', 'data_cube')
+PATH_MANIFEST = os.path.join(PATH, '_manifest.json')
+
+logger = logging.getLogger(__name__)
+
+def main(full=False):
+
+    # Se cargan los datos y los filtros tal como los usa el dashboard, para que las figuras
+    # guardadas correspondan a las mismas claves
+    version = dataset_version(PATH)
+    cube = read_cube(PATH_CUBE, cat_study)
+    metadata = read_manifest(PATH_MANIFEST).get('metadata') or dataset_metadata(cube)
+    states = metadata['states']
+    years = metadata['years']
+    years_string = [str(item) for item in years]
+
+    data = read_dataset(PATH, columns=['State', 'Year'] + vars_study)
+    index = build_row_index(data)
+    totals = build_state_totals(cube['State'], ['Total accidents'] + vars_study, code_state)
+
+    cat_tab2 = [cat for cat in cat_study if cat != 'Year']
+    state_options = [states] + states
+    year_options = [years_string] + years_string
+
+    start = time.perf_counter()
+    for state_filter in state_options:
+        count_graph(cube, version, state_filter, years, 'Year')
+        for year_filter in year_options:
+            count_graph(cube, version, state_filter, year_filter, cat_tab2[0])
+            sum_stats_study(cube, version, state_filter, year_filter, vars_study[0], cat_tab2[0])
+            scatter_graph(data, version, year_filter, state_filter,
+                          x_var=vars_study[0], y_var=vars_study[0], z_var=vars_study[0], _index=index)
+
+    for year_filter in year_options:
+        for var_filter in (vars_study if full else vars_study[:1]):
+            choropleth_graph(totals, version, year_filter, var_filter)
+
+    if full:
+        for year_filter in year_options:
+            for cat in cat_tab2:
+                count_graph(cube, version, states, year_filter, cat)
+                for var in vars_study:
+                    sum_stats_study(cube, version, states, year_filter, var, cat)
+
+    # Las estadísticas se leen de la caché en disco, y no de la caché en memoria ni de las trazas
+    # que envuelven a cada función
+    cache_info = figure_cache_info()
+    for func in (count_graph, sum_stats_study, scatter_graph, choropleth_graph):
+        info = cache_info[func.__name__]
+        logger.info('%s: %d generadas, %d ya en caché', func.__name__, info['misses'], info['hits'])
+    logger.info('Caché de figuras: %d archivos, %d bytes, %.1f s',
+                info['files'], info['bytes'], time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Genera las figuras del dashboard en la caché en disco')
+    parser.add_argument('--full', action='store_true',
+                        help='Genera también el conteo y la suma por cada categoría y variable')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(full=args.full)
@@ -0,0 +1,392 @@
+"""
+Este archivo contiene las consultas de agregación sobre el cubo de accidentes (ver common.aggregate_cube),
+independientes de Streamlit y de las figuras: conteo, suma, top-N y series de tiempo por Estado, Año y
+categoría, y series por periodo del calendario (año, trimestre, mes, semana, día y hora). Las usan las
+funciones de graphs.py, el servicio query_service.py y cualquier otro proceso que necesite los valores
+sin iniciar el dashboard
+
+Cada consulta se describe con un diccionario serializable en JSON, por ejemplo
+{'query': 'count', 'states': ['Texas'], 'years': [2020], 'category': 'Month'}, y su resultado es un
+diccionario con las columnas y las filas de la tabla ({'columns': [...], 'data': [[...], ...]})
+"""
+
+import itertools
+import json
+import logging
+import urllib.error
+import urllib.request
+import numpy as np
+import pandas as pd
+from common import replace_name, cache_result, TOP_LIST_SIZE
+from tracing import traced
+
+logger = logging.getLogger(__name__)
+
+# Categorías del cubo que se pueden usar como eje de una serie de tiempo
+SERIES_CATEGORIES = ['Year', 'Month', 'Day of month', 'Day of week', 'Hour']
+
+# Niveles de las series del almacén de series de tiempo y la frecuencia de sus periodos
+TREND_LEVELS = {'year': 'Y', 'quarter': 'Q', 'month': 'M', 'week': 'W', 'day': 'D', 'hour': None}
+
+def _select(cube, category, states=None, years=None):
+    """
+    Returns the rows of the cube table of a category for the given states and years.
+    """
+    if category not in cube or category.startswith('_'):
+        raise ValueError(f'Categoría desconocida: {category}')
+    return _filter(cube[category], states, years)
+
+def _filter(table, states=None, years=None):
+    """
+    Returns the rows of a table for the given states and years.
+    """
+    mask = pd.Series(True, index=table.index)
+    if states is not None:
+        states = states if isinstance(states, list) else [states]
+        mask &= table['State'].isin(states)
+    if years is not None:
+        years = years if isinstance(years, list) else [years]
+        mask &= table['Year'].isin([int(item) for item in years])
+    return table[mask]
+
+def _check_measure(cube, category, measure):
+    """
+    Raises a ValueError if the measure is not a column of the cube.
+    """
+    if measure not in cube[category].columns or measure in ('State', 'Year', category):
+        raise ValueError(f'Variable desconocida: {measure}')
+
+def _head(table, category, measure, top=None):
+    """
+    Removes the 'Not Applicable' cities and keeps the top rows with the largest measure.
+
+    The top rows are found by partial selection (DataFrame.nlargest) instead of sorting all the rows.
+    """
+    if category == 'City':
+        table = table[table[category] != "Not Applicable"]
+    if top is not None:
+        table = table.nlargest(int(top), measure)
+    return table
+
+def _from_top_lists(cube, category, measure, states, years, n):
+    """
+    Answers a top-n query from the top lists of the cube (see common.build_top_lists).
+
+    A selection of the dashboard (one or all states, one or all years) is read from its own list.
+    Other selections merge the lists of each State and Year: a value missing from the list of a
+    State and Year adds at most the last value of that list, so the merged top n is exact when
+    its values appear in every list that could add to them, and no other value can reach them.
+
+    Returns:
+        pandas.DataFrame: The columns category and measure, or None if the lists cannot answer the query.
+    """
+    top_lists = cube.get('_top', {}).get(category)
+    if top_lists is None or n > TOP_LIST_SIZE:
+        return None
+    if states is not None:
+        states = set(states if isinstance(states, list) else [states])
+    if years is not None:
+        years = set(int(item) for item in (years if isinstance(years, list) else [years]))
+    state_keys = [''] if states is None or states >= top_lists['states'] else sorted(states)
+    year_keys = [0] if years is None or years >= top_lists['years'] else sorted(years)
+
+    cells = [top_lists['cells'][key] for key in itertools.product([measure], state_keys, year_keys)
+             if key in top_lists['cells']]
+    if not cells:
+        return None
+    rows = top_lists['lists'].iloc[np.concatenate(cells)]
+    if len(cells) == 1:
+        return rows[[category, 'Value']].head(n).rename(columns={'Value': measure}).reset_index(drop=True)
+
+    # Las listas con menos de TOP_LIST_SIZE valores están completas
+    sizes = np.array([len(item) for item in cells])
+    thresholds = np.where(sizes >= TOP_LIST_SIZE, rows['Value'].to_numpy()[np.cumsum(sizes) - 1], 0)
+    names = rows[category].to_numpy()
+    partial = rows['Value'].groupby(names).sum()
+    present = pd.Series(np.repeat(thresholds, sizes)).groupby(names).sum()
+    upper = partial + thresholds.sum() - present
+    best = partial.nlargest(n)
+    others = upper.drop(best.index)
+    bound = max(others.max() if len(others) else 0, thresholds.sum())
+    if len(best) < n and thresholds.sum() > 0:
+        return None
+    if (upper[best.index] != best).any() or (len(best) and best.iloc[-1] < bound):
+        return None
+    return pd.DataFrame({category: pd.Categorical(best.index, dtype=rows[category].dtype),
+                         measure: best.to_numpy()})
+
+def count(cube, category, states=None, years=None, top=None):
+    """
+    Counts the accidents of each value of a category.
+
+    The values without accidents are left out. The rows are sorted by the order of the category
+    if it is ordinal (e.g. 'Month'), and otherwise by the number of accidents, in descending order.
+
+    Args:
+        cube (dict): The cube of the dataset (see common.aggregate_cube).
+        category (str): The category to count by.
+        states (str or list, optional): The state or states to include. Default is all of them.
+        years (int, str or list, optional): The year or years to include. Default is all of them.
+        top (int, optional): Keeps only the values with the most accidents, read from the top lists of
+            the cube when they can answer the query. Default is all of them.
+
+    Returns:
+        pandas.DataFrame: The columns category and 'Total accidents'.
+    """
+    if top is not None:
+        ranked = _from_top_lists(cube, category, 'Total accidents', states, years, int(top))
+        if ranked is not None:
+            return ranked
+    table = _select(cube, category, states, years)
+    counts = table.groupby(category, observed=True)['Total accidents'].sum()
+    counts = counts[counts > 0].sort_values(ascending=False).reset_index()
+    counts.columns = [category, 'Total accidents']
+    counts = replace_name(counts, category)
+    return _head(counts, category, 'Total accidents', top)
+
+def total(cube, category, measure, states=None, years=None, top=None):
+    """
+    Adds up a measure for each value of a category.
+
+    Args:
+        cube (dict): The cube of the dataset (see common.aggregate_cube).
+        category (str): The category to group by.
+        measure (str): The measure to add up, e.g. 'Fatals' or 'Total accidents'.
+        states (str or list, optional): The state or states to include. Default is all of them.
+        years (int, str or list, optional): The year or years to include. Default is all of them.
+        top (int, optional): Keeps only the values with the largest sums, read from the top lists of
+            the cube when they can answer the query. Default is all of them.
+
+    Returns:
+        pandas.DataFrame: The columns category and measure, in the order of the category.
+    """
+    if top is not None:
+        ranked = _from_top_lists(cube, category, measure, states, years, int(top))
+        if ranked is not None:
+            return ranked
+    table = _select(cube, category, states, years)
+    _check_measure(cube, category, measure)
+    sums = table.groupby(category, observed=True)[measure].sum().reset_index()
+    sums = replace_name(sums, category)
+    return _head(sums, category, measure, top)
+
+def top(cube, category, measure='Total accidents', states=None, years=None, n=20):
+    """
+    Returns the values of a category with the largest sums of a measure, in descending order.
+
+    Args:
+        cube (dict): The cube of the dataset (see common.aggregate_cube).
+        category (str): The category to rank, e.g. 'City'.
+        measure (str, optional): The measure to rank by. Default is 'Total accidents'.
+        states (str or list, optional): The state or states to include. Default is all of them.
+        years (int, str or list, optional): The year or years to include. Default is all of them.
+        n (int, optional): The number of values to return. Default is 20.
+
+    Returns:
+        pandas.DataFrame: The columns category and measure.
+    """
+    return total(cube, category, measure, states, years, top=n)
+
+def series(cube, measure='Total accidents', category='Year', states=None, years=None, by=None):
+    """
+    Adds up a measure along a calendar category, optionally split by State or Year.
+
+    Args:
+        cube (dict): The cube of the dataset (see common.aggregate_cube).
+        measure (str, optional): The measure to add up. Default is 'Total accidents'.
+        category (str, optional): The axis of the series, one of SERIES_CATEGORIES. Default is 'Year'.
+        states (str or list, optional): The state or states to include. Default is all of them.
+        years (int, str or list, optional): The year or years to include. Default is all of them.
+        by (str, optional): 'State' or 'Year' to return one series per state or year. Default is None.
+
+    Returns:
+        pandas.DataFrame: The columns by (if given), category and measure, sorted by them.
+    """
+    if category not in SERIES_CATEGORIES:
+        raise ValueError(f'La categoría {category} no es una serie de tiempo')
+    if by not in (None, 'State', 'Year') or by == category:
+        raise ValueError(f'No se puede separar la serie por {by}')
+    table = _select(cube, category, states, years)
+    _check_measure(cube, category, measure)
+    keys = [category] if by is None else [by, category]
+    result = table.groupby(keys, observed=True)[measure].sum().reset_index()
+    return result.sort_values(keys, kind='stable').reset_index(drop=True)
+
+def trend(cube, level='month', measure='Total accidents', states=None, years=None, start=None, end=None, by=None):
+    """
+    Adds up a measure per calendar period, from the rollup store of the cube (see common.aggregate_rollup).
+
+    The levels 'year', 'quarter', 'month', 'week' and 'day' roll up the daily table, so a level is
+    drilled down by asking for a finer one between start and end. The accidents with an unknown
+    day count in their month, quarter and year, but not in any week or day. The level 'hour'
+    adds up the hours of the day, and with by='Day of week' it returns an hour by weekday grid.
+
+    Args:
+        cube (dict): The cube of the dataset, with its rollup store (see common.read_cube).
+        level (str, optional): One of TREND_LEVELS. Default is 'month'.
+        measure (str, optional): The measure to add up. Default is 'Total accidents'.
+        states (str or list, optional): The state or states to include. Default is all of them.
+        years (int, str or list, optional): The year or years to include. Default is all of them.
+        start (str, optional): The first date to include, e.g. '2020-03-01'. Default is no limit.
+        end (str, optional): The last date to include, e.g. '2020-03-31'. Default is no limit.
+        by (str, optional): 'State' to return one series per state, or 'Day of week' for the level 'hour'.
+            Default is None.
+
+    Returns:
+        pandas.DataFrame: The columns by (if given), Period (or Hour) and measure, sorted by them.
+    """
+    rollup = cube.get('_rollup')
+    if not rollup:
+        raise ValueError('El cubo no tiene el almacén de series de tiempo')
+    if level not in TREND_LEVELS:
+        raise ValueError(f'Nivel desconocido: {level}')
+    if by not in (None, 'State') and not (level == 'hour' and by == 'Day of week'):
+        raise ValueError(f'No se puede separar la serie por {by}')
+
+    table = _filter(rollup['Hour' if level == 'hour' else 'Day'], states, years)
+    if measure not in table.columns or measure in ('State', 'Year'):
+        raise ValueError(f'Variable desconocida: {measure}')
+    keys = [] if by is None else [by]
+
+    if level == 'hour':
+        if start is not None or end is not None:
+            raise ValueError("El nivel 'hour' no admite un rango de fechas")
+        keys = keys + ['Hour']
+        result = table.groupby(keys, observed=True)[measure].sum().reset_index()
+        return result.sort_values(keys, kind='stable').reset_index(drop=True)
+
+    # Los años, trimestres y meses se calculan con el primer día del mes, que siempre existe,
+    # y las semanas y días con la fecha de cada accidente
+    dates = table['Month start'] if level in ('year', 'quarter', 'month') else table['Date']
+    try:
+        mask = dates.notna()
+        if start is not None:
+            mask &= dates >= pd.Timestamp(start)
+        if end is not None:
+            mask &= dates <= pd.Timestamp(end)
+    except ValueError as error:
+        raise ValueError(f'Fecha no válida: {error}') from error
+    table, dates = table[mask], dates[mask]
+    periods = dates.dt.to_period(TREND_LEVELS[level]).rename('Period')
+    result = table.groupby([table[key] for key in keys] + [periods], observed=True)[measure].sum().reset_index()
+    result = result.sort_values(keys + ['Period'], kind='stable').reset_index(drop=True)
+    result['Period'] = result['Period'].astype(str)
+    return result
+
+QUERIES = {'count': count, 'sum': total, 'top': top, 'series': series, 'trend': trend}
+
+def to_result(table):
+    """
+    Converts the table of a query into a dict that can be serialized as JSON.
+
+    Args:
+        table (pandas.DataFrame): The table returned by a query.
+
+    Returns:
+        dict: The columns and the rows of the table.
+    """
+    return json.loads(table.to_json(orient='split', index=False))
+
+def to_frame(result):
+    """
+    Converts the result of a query back into a pandas DataFrame.
+
+    Args:
+        result (dict): The result of execute or of the query service.
+
+    Returns:
+        pandas.DataFrame: The table of the query.
+
+    Raises:
+        ValueError: If the query failed.
+    """
+    if 'error' in result:
+        raise ValueError(result['error'])
+    return pd.DataFrame(result['data'], columns=result['columns'])
+
+@traced('queries.execute')
+@cache_result(maxsize=256)
+def execute(_cube, version, query):
+    """
+    Runs a query over the cube.
+
+    Args:
+        _cube (dict): The cube of the dataset (see common.aggregate_cube).
+        version (str): The version of the dataset the cube was built from, used as the cache key (see common.dataset_version).
+        query (dict): The name of the query under 'query' ('count', 'sum', 'top' or 'series') and its arguments,
+            e.g. {'query': 'sum', 'category': 'Month', 'measure': 'Fatals', 'years': [2020]}.
+
+    Returns:
+        dict: The columns and the rows of the result (see to_result).
+
+    Raises:
+        ValueError: If the query or its arguments are not valid.
+    """
+    args = dict(query)
+    name = args.pop('query', None)
+    if name not in QUERIES:
+        raise ValueError(f'Consulta desconocida: {name}')
+    try:
+        table = QUERIES[name](_cube, **args)
+    except TypeError as error:
+        raise ValueError(f'Argumentos no válidos para la consulta {name}: {error}') from error
+    return to_result(table)
+
+def request_service(url, queries, timeout=30):
+    """
+    Sends a batch of queries to the query service (see query_service.py).
+
+    Args:
+        url (str): The base URL of the service, e.g. 'http://127.0.0.1:8765'.
+        queries (list): The queries to run.
+        timeout (float, optional): The timeout of the request in seconds. Default is 30.
+
+    Returns:
+        list: The result of each query, in the same order.
+    """
+    body = json.dumps({'queries': queries}).encode('utf-8')
+    request = urllib.request.Request(url.rstrip('/') + '/query', data=body,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))['results']
+
+def run_queries(cube, version, queries, url=None):
+    """
+    Runs a batch of queries on the query service if its URL is given, and otherwise in this process.
+
+    If the service cannot be reached, the queries are run in this process, so the dashboard
+    keeps working while the service is restarted.
+
+    Args:
+        cube (dict): The cube of the dataset, used when the queries are run in this process.
+        version (str): The version of the dataset (see common.dataset_version).
+        queries (list): The queries to run.
+        url (str, optional): The base URL of the query service. Default is None.
+
+    Returns:
+        list: The result of each query, in the same order. A failed query has an 'error' instead of rows.
+    """
+    if url:
+        try:
+            return request_service(url, queries)
+        except (urllib.error.URLError, OSError) as error:
+            logger.warning('No se pudo consultar el servicio %s, se consulta localmente: %s', url, error)
+    results = []
+    for query in queries:
+        try:
+            results.append(execute(cube, version, query))
+        except ValueError as error:
+            results.append({'error': str(error)})
+    return results
+
+def query_frame(cube, version, query, url=None):
+    """
+    Runs one query (see run_queries) and returns its table.
+
+    Returns:
+        pandas.DataFrame: The table of the query.
+
+    Raises:
+        ValueError: If the query failed.
+    """
+    return to_frame(run_queries(cube, version, [query], url)[0])
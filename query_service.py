@@ -0,0 +1,211 @@
+"""
+Este script inicia un servicio HTTP local que responde en JSON las consultas de queries.py sobre el cubo
+de accidentes, para que los trabajos de reportes, otros servicios y las réplicas del dashboard obtengan
+los valores de un único proceso, sin iniciar Streamlit
+
+Endpoints:
+    GET  /health   Estado del servicio y versión de los datos
+    GET  /metadata Estados, años y accidentes por año
+    POST /query    Una consulta ({'query': 'count', ...}) o un lote ({'queries': [{...}, ...]})
+
+Las consultas que llegan dentro de una misma ventana de tiempo se agrupan en un lote: las consultas
+idénticas se ejecutan una sola vez, y las demás se reparten en un grupo de hilos de trabajo. Los datos
+se vuelven a leer cuando cambia la versión del dataset (ver common.dataset_version)
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common import read_cube, read_manifest, dataset_metadata, dataset_version
+from queries import execute
+from rename import cat_study
+
+PATH = os.path.join('data', 'data_accident')
+PATH_CUBE = os.path.join('data', 'data_cube')
+
+logger = logging.getLogger(__name__)
+
+class QueryService:
+    """
+    Runs the queries of queries.py in batches on a pool of worker threads.
+
+    The queries submitted within batch_ms of each other are run as one batch, in which
+    identical queries are run only once.
+    """
+
+    def __init__(self, path=PATH, cube_path=PATH_CUBE, workers=4, batch_ms=5):
+        self.path = path
+        self.cube_path = cube_path
+        self.batch_ms = batch_ms
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query')
+        self.pending = queue.Queue()
+        self.version = None
+        self.cube = None
+        self.metadata = None
+        self.stats = {'queries': 0, 'batches': 0, 'executed': 0}
+        self.refresh()
+        threading.Thread(target=self._dispatch, name='query-batcher', daemon=True).start()
+
+    def refresh(self):
+        """
+        Reads the cube again if the version of the dataset changed.
+        """
+        version = dataset_version(self.path)
+        if version != self.version:
+            cube = read_cube(self.cube_path, cat_study)
+            manifest = read_manifest(os.path.join(self.path, '_manifest.json'))
+            self.cube, self.version = cube, version
+            self.metadata = manifest.get('metadata') or dataset_metadata(cube)
+            logger.info('Datos cargados, versión %s', version)
+
+    def submit(self, queries):
+        """
+        Queues a list of queries and returns a future for the result of each one.
+        """
+        futures = []
+        for query in queries:
+            future = Future()
+            self.pending.put((query, future))
+            futures.append(future)
+        return futures
+
+    def _dispatch(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.batch_ms / 1000
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Si los datos no se pueden leer, p. ej. porque el ETL los está escribiendo, se siguen
+            # respondiendo las consultas con los datos anteriores
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('No se pudieron leer los datos, se mantiene la versión %s', self.version)
+
+            # Ningún error detiene este hilo, y toda consulta del lote recibe una respuesta
+            try:
+                groups = {}
+                for query, future in batch:
+                    key = json.dumps(query, sort_keys=True, default=str)
+                    groups.setdefault(key, (query, []))[1].append(future)
+                self.stats['queries'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['executed'] += len(groups)
+                for query, futures in groups.values():
+                    self.pool.submit(self._run, self.cube, self.version, query, futures)
+            except Exception as error:
+                logger.exception('Error al repartir el lote de consultas')
+                for _, future in batch:
+                    try:
+                        future.set_result({'error': f'Error interno: {error}'})
+                    except InvalidStateError:
+                        pass
+
+    @staticmethod
+    def _run(cube, version, query, futures):
+        try:
+            if not isinstance(query, dict):
+                raise ValueError('Cada consulta debe ser un objeto JSON')
+            result = execute(cube, version, query)
+        except ValueError as error:
+            result = {'error': str(error)}
+        except Exception as error:
+            logger.exception('Error en la consulta %s', query)
+            result = {'error': f'Error interno: {error}'}
+        for future in futures:
+            future.set_result(result)
+
+def make_handler(service, timeout=60):
+    """
+    Builds the HTTP request handler of a QueryService.
+
+    Args:
+        service (QueryService): The service that runs the queries.
+        timeout (float, optional): The maximum time in seconds to wait for a batch. Default is 60.
+
+    Returns:
+        type: The request handler class, for http.server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok', 'version': service.version, **service.stats})
+            elif self.path == '/metadata':
+                self._send(200, {'version': service.version, **service.metadata})
+            else:
+                self._send(404, {'error': 'Ruta desconocida'})
+
+        def do_POST(self):
+            if self.path != '/query':
+                self._send(404, {'error': 'Ruta desconocida'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+            except (ValueError, UnicodeDecodeError):
+                self._send(400, {'error': 'El cuerpo debe ser un objeto JSON'})
+                return
+
+            batch = isinstance(body, dict) and 'queries' in body
+            queries = body['queries'] if batch else [body]
+            if not isinstance(queries, list):
+                self._send(400, {'error': "'queries' debe ser una lista"})
+                return
+            try:
+                results = [future.result(timeout) for future in service.submit(queries)]
+            except FutureTimeout:
+                self._send(503, {'error': 'Tiempo de espera agotado'})
+                return
+            if batch:
+                self._send(200, {'version': service.version, 'results': results})
+            else:
+                self._send(400 if 'error' in results[0] else 200, {'version': service.version, **results[0]})
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return Handler
+
+def main(host='127.0.0.1', port=8765, workers=4, batch_ms=5):
+    service = QueryService(workers=workers, batch_ms=batch_ms)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logger.info('Servicio de consultas en http://%s:%d con %d hilos', host, port, workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Servicio HTTP de consultas sobre el cubo de accidentes')
+    parser.add_argument('--host', default='127.0.0.1', help='Dirección en la que escucha el servicio')
+    parser.add_argument('--port', type=int, default=8765, help='Puerto del servicio')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Número de hilos de trabajo')
+    parser.add_argument('--batch-ms', type=float, default=5, help='Ventana de agrupación de consultas en milisegundos')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    main(host=args.host, port=args.port, workers=args.workers, batch_ms=args.batch_ms)
@@ -1,6 +1,8 @@
 """
 Este archivo contiene listas y diccionarios que se usan para renombrar atributos
-y registros del conjunto de datos, mediante un proceso de ETL
+y registros del conjunto de datos, mediante un proceso de ETL, así como los esquemas
+de tipos de datos con los que se leen los archivos fuente y se exporta el conjunto de datos, y las
+categorías y variables de estudio del dashboard
 """
 
 cols_filter = ["STATENAME", "COUNTY",	"CITY",
@@ -11,6 +13,20 @@ cols_filter = ["STATENAME", "COUNTY",	"CITY",
                "LATITUDE", "LONGITUD",
                "LGT_CONDNAME", "WEATHERNAME", "FATALS"]
 
+cat_study = ['State', 'City', 'County', 'Day of month', 
+             'Month', 'Year', 'Day of week', 'Hour', 'Route', 'Ligth condition', 'Climatic condition']     
+vars_study = ['Fatals', 'Total vehicles involved', 'Vehicles in motion', 
+              'Parked vehicles', 'Pedestrian', 'Cyclists', 'Persons in Vehicles']
+
+raw_dtypes = {"STATE": "int16", "COUNTY": "int16", "CITY": "int16",
+              "PEDS": "int16", "PERNOTMVIT": "int16", "VE_TOTAL": "int16",
+              "VE_FORMS": "int16", "PVH_INVL": "int16", "PERSONS": "int16", "PERMVIT": "int16",
+              "MONTH": "int16", "DAY": "int16", "DAY_WEEK": "int16", "YEAR": "int16", 
+              "HOUR": "int16", "ROUTE": "int16", "LGT_COND": "int16", "WEATHER": "int16",
+              "LATITUDE": "float64", "LONGITUD": "float64", "FATALS": "int16",
+              "STATENAME": "category", "MONTHNAME": "category", "DAY_WEEKNAME": "category", 
+              "ROUTENAME": "category", "LGT_CONDNAME": "category", "WEATHERNAME": "category"}
+
 state_name = {  1: 'Alabama',
                 2: 'Alaska',
                 4: 'Arizona',
@@ -153,6 +169,16 @@ route = dict(zip([1, 2, 3, 4, 5, 6, 7, 8, 9],
                   "Local Street – Township", "Local Street – Municipality", 
                   "Local Street – Frontage Road", "Other", "Unknown"]))
 
+county_code_special = {0: "Not Applicable",
+                       997: "Other",
+                       998: "Not Reported",
+                       999: "Unknown"}
+
+city_code_special = {0: "Not Applicable",
+                     9997: "Other",
+                     9898: "Not Reported",
+                     9999: "Unknown"}
+
 change_name = {
             'statename': 'State',
             've_total': 'Total vehicles involved',
@@ -172,4 +198,78 @@ change_name = {
             'lgt_condname': 'Ligth condition',
             'weathername': 'Climatic condition',
             'fatals': 'Fatals'
+            }
+
+# Orden de las categorías ordinales del conjunto de datos. Las columnas incluidas se exportan
+# como categorías ordenadas, de modo que los gráficos se ordenan por su código
+ordinal_categories = {
+            'Month': [month_name[code] for code in sorted(month_name)],
+            'Day of week': [dayweek_name[code] for code in sorted(dayweek_name)]
+            }
+
+col_dtypes = {
+            'State': 'category',
+            'County': 'category',
+            'City': 'category',
+            'code_state': 'category',
+            'Month': 'category',
+            'Day of week': 'category',
+            'Route': 'category',
+            'Ligth condition': 'category',
+            'Climatic condition': 'category',
+            'Year': 'int16',
+            'Day of month': 'int8',
+            'Hour': 'int8',
+            'Fatals': 'int16',
+            'Total vehicles involved': 'int16',
+            'Vehicles in motion': 'int16',
+            'Parked vehicles': 'int16',
+            'Pedestrian': 'int16',
+            'Cyclists': 'int16',
+            'persons': 'int16',
+            'Persons in Vehicles': 'int16',
+            'latitude': 'float32',
+            'longitud': 'float32'
+            }
+
+# Reglas de calidad de los datos, que se verifican en el proceso de ETL (ver common.validate_data)
+
+# Códigos con los que la NHTSA registra los valores desconocidos o no reportados
+sentinel_codes = {
+            'Hour': [99],
+            'Day of month': [99],
+            'latitude': [77.7777, 88.8888, 99.9999],
+            'longitud': [777.7777, 888.8888, 999.9999]
+            }
+
+# Rango válido (mínimo, máximo) de las variables numéricas. None indica que no hay límite
+value_ranges = {
+            'Hour': (0, 23),
+            'Day of month': (1, 31),
+            'Fatals': (1, None),
+            'Total vehicles involved': (1, None),
+            'Vehicles in motion': (0, None),
+            'Parked vehicles': (0, None),
+            'Pedestrian': (0, None),
+            'Cyclists': (0, None),
+            'persons': (0, None),
+            'Persons in Vehicles': (0, None)
+            }
+
+# Límites de las coordenadas de los Estados Unidos, incluidos Alaska y Hawái. Las coordenadas
+# fuera de estos límites se eliminan del conjunto de datos
+coordinate_bounds = {
+            'latitude': (18.0, 72.0),
+            'longitud': (-180.0, -64.0)
+            }
+
+# Valores válidos de las variables categóricas
+category_domains = {
+            'State': list(state_name.values()),
+            'code_state': list(code_state.values()),
+            'Month': list(month_name.values()),
+            'Day of week': list(dayweek_name.values()),
+            'Route': list(route.values()),
+            'Ligth condition': list(lgt_cond.values()),
+            'Climatic condition': list(weather.values())
             }
\ No newline at end of file
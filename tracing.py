@@ -0,0 +1,168 @@
+"""
+Este archivo contiene una capa de trazas para medir el tiempo y el número de filas de cada etapa
+de las funciones de los gráficos, de la carga de datos y del proceso de ETL.
+
+Las trazas se activan con la variable de entorno ACCIDENT_TRACE=1. Cuando no está activa, el decorador
+traced devuelve la función sin cambios y span devuelve un objeto vacío, por lo que no tienen costo.
+Cada etapa se registra como una línea JSON en el logger 'accident.trace', y opcionalmente en el archivo
+indicado en la variable ACCIDENT_TRACE_FILE
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('ACCIDENT_TRACE', '').lower() in ('1', 'true', 'yes')
+
+logger = logging.getLogger('accident.trace')
+if ENABLED and os.environ.get('ACCIDENT_TRACE_FILE'):
+    _handler = logging.FileHandler(os.environ['ACCIDENT_TRACE_FILE'], encoding='utf-8')
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+_local = threading.local()
+
+class _NoopSpan:
+    """
+    Span returned when tracing is disabled; every operation does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP = _NoopSpan()
+
+class Span:
+    """
+    Measures the wall time of a stage, with attributes such as its number of rows.
+
+    Spans opened inside another span of the same thread are recorded as its children.
+    """
+    __slots__ = ('name', 'attrs', 'parent', 'depth', 'start', 'duration')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.parent = None
+        self.depth = 0
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            self.parent = stack[-1].name
+            self.depth = len(stack)
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        _stack().pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        record = {'span': self.name, 'ms': round(self.duration * 1000, 3), 'parent': self.parent,
+                  'depth': self.depth, 'pid': os.getpid(), 'thread': threading.current_thread().name,
+                  **self.attrs}
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append(record)
+        logger.info(json.dumps(record, default=str))
+        return False
+
+    def set(self, **attrs):
+        """
+        Adds attributes to the span, e.g. rows=len(data).
+        """
+        self.attrs.update(attrs)
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def span(name, **attrs):
+    """
+    Opens a span that measures the stage run inside a with block.
+
+    Args:
+        name (str): The name of the stage.
+        **attrs: Attributes of the stage, such as its number of rows.
+
+    Returns:
+        Span: The span, or an empty span if tracing is disabled.
+    """
+    if not ENABLED:
+        return _NOOP
+    return Span(name, attrs)
+
+def annotate(**attrs):
+    """
+    Adds attributes to the innermost open span of the current thread, if any.
+
+    Args:
+        **attrs: The attributes to add, e.g. cache='hit'.
+
+    Returns:
+        None
+    """
+    if ENABLED:
+        stack = _stack()
+        if stack:
+            stack[-1].attrs.update(attrs)
+
+def traced(name=None):
+    """
+    Decorates a function so that each call is measured as a span.
+
+    If tracing is disabled, the function is returned unchanged.
+
+    Args:
+        name (str, optional): The name of the span. Default is the name of the function.
+
+    Returns:
+        function: The decorator.
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start_trace():
+    """
+    Starts collecting the spans of the current thread, e.g. for one rerun of the dashboard.
+
+    Returns:
+        None
+    """
+    if ENABLED:
+        _local.spans = []
+
+def collect():
+    """
+    Returns the spans collected in the current thread since start_trace.
+
+    Returns:
+        list: One dict per span, in the order they finished.
+    """
+    return list(getattr(_local, 'spans', None) or [])